@@ -0,0 +1,58 @@
+from airflow import DAG
+from airflow.operators.python import PythonOperator
+from datetime import datetime, timedelta
+import importlib
+import sys
+
+# Définition des DAGs
+default_args = {
+    'owner': 'airflow',
+    'depends_on_past': False,
+    'start_date': datetime(2024, 3, 8),
+    'retries': 1,
+    'retry_delay': timedelta(minutes=5),
+}
+
+# Les deux pipelines ne diffèrent que par leurs scripts, ils sont générés depuis un seul fichier
+# (dag_id, scripts exécutés dans l'ordre) - les dag_id sont ceux déclenchés par l'API (src/main.py)
+PIPELINES = [
+    ('datalake_pipeline', ['unpacked_to_raw', 'faster_preprocess_to_staging', 'faster_process_to_curated']),
+    ('regular_datalake_pipeline', ['unpacked_to_raw', 'preprocess_to_staging', 'process_to_curated']),
+]
+
+SRC_DIR = '/opt/airflow/src'
+
+def run_main(module_name, **kwargs):
+    # Run the script's main() inside the worker process instead of spawning a new Python interpreter.
+    # The import is done here (not at the top of the file) so the scheduler does not load pandas/boto3/cassandra each time it parses the DAG.
+    if SRC_DIR not in sys.path:
+        sys.path.append(SRC_DIR)
+    importlib.import_module(module_name).main()
+
+for dag_id, scripts in PIPELINES:
+    dag = DAG(
+        dag_id,
+        default_args=default_args,
+        description='Pipeline Airflow pour orchestrer les scripts de transformation',
+        schedule_interval='@daily',
+        catchup=False,
+    )
+
+    # Opérateurs Python pour chaque transformation (la tâche porte le nom du script)
+    tasks = [
+        PythonOperator(
+            task_id=script,
+            python_callable=run_main,
+            op_args=[script],
+            provide_context=True,
+            dag=dag,
+        )
+        for script in scripts
+    ]
+
+    # Définition de l'ordre d'exécution
+    for upstream_task, downstream_task in zip(tasks, tasks[1:]):
+        upstream_task >> downstream_task
+
+    # Airflow only discovers DAG objects bound at module level
+    globals()[dag_id] = dag
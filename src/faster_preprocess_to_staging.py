@@ -1,17 +1,56 @@
 import os
+import sys
 import re
 import csv
 import io
 import yaml
 import unicodedata
 import time
+import tempfile
+import threading
 import datetime
+from functools import lru_cache
+import xxhash
 import boto3
+import pandas as pd
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+import pyarrow as pa
+import pyarrow.compute as pc
+from pyarrow import csv as pa_csv
+from cassandra import ConsistencyLevel
 from cassandra.cluster import Cluster
+from cassandra.query import BatchStatement, BatchType
+from cassandra.concurrent import execute_concurrent, execute_concurrent_with_args
+from cassandra.policies import DCAwareRoundRobinPolicy, TokenAwarePolicy
 from concurrent.futures import ThreadPoolExecutor, as_completed
-import threading
 
+# C implementation of the YAML parser (libyaml) when PyYAML was built with it
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+
+# Bound once, called for every data row
+xxh3_64_intdigest = xxhash.xxh3_64_intdigest
+
+
+# Compiled once instead of on every normalized column name
+NON_ALPHANUMERIC_RE = re.compile(r'[^a-z0-9]+')
 
+# Accented letters of the (French) headers mapped to their ASCII letter, UTF-8 BOM removed
+ACCENTED_LETTERS = 'àâäáãåçéèêëîïíìôöóòõûüúùÿýñ'
+ASCII_LETTERS = 'aaaaaaceeeeiiiiooooouuuuyyn'
+ACCENT_TABLE = str.maketrans(
+    ACCENTED_LETTERS + ACCENTED_LETTERS.upper(),
+    ASCII_LETTERS + ASCII_LETTERS.upper(),
+    '\ufeff'
+)
+
+
+# Headers share a small set of column names, so each one is normalized only once
+@lru_cache(maxsize=1024)
 def normalize_column_name(col):
     """
     Normalize column names to valid Cassandra identifiers:
@@ -20,49 +59,140 @@ def normalize_column_name(col):
       - Replace any non-alphanumeric characters with underscores
       - If a column starts with a digit, prefix it with an underscore
     """
-    # Remove accents and convert to ascii
-    col = unicodedata.normalize('NFKD', col).encode('ASCII', 'ignore').decode('utf-8')
+    # Remove accents with the translation table, unicodedata is only needed for other non-ascii characters
+    col = col.translate(ACCENT_TABLE)
+    if not col.isascii():
+        col = unicodedata.normalize('NFKD', col).encode('ASCII', 'ignore').decode('utf-8')
     col = col.lower().strip()
     
     # Replace non-alphanumeric characters with underscore
-    col = re.sub(r'[^a-z0-9]+', '_', col)
+    col = NON_ALPHANUMERIC_RE.sub('_', col)
     
     # If the first character is a digit, prefix with underscore
     if col and col[0].isdigit():
         col = "_" + col
     
-    return col
+    # Interned so that the normalized names of every file are the same string objects: header comparisons
+    # between files and column lookups in the converter/type dicts then succeed on identity
+    return sys.intern(col)
+
 
+# Date formats of the CSV files (with and without a time component)
+DATE_TIME_FORMAT = "%Y/%m/%d %H:%M:%S"
+DATE_FORMAT = "%Y/%m/%d"
 
-def convert_value(col_name, value):
+
+def make_date_converter(col_name):
     """
-    Convert CSV string values to the appropriate Python types based on the column.
+    Build a converter parsing CSV date strings of the given column to datetime objects.
     """
-    if value == "" or value is None:
-        return None
-
-    # Convert date columns to datetime objects.
-    if col_name in ('date_de_debut', 'date_de_fin'):
-        # Try parsing with a datetime format. Adjust the format if needed.
+    # Bound once in the closure instead of looking up the datetime methods for every cell
+    fromisoformat = datetime.datetime.fromisoformat
+    strptime = datetime.datetime.strptime
+    
+    def convert(value):
+        if not value:
+            return None
+        # "YYYY/MM/DD[ HH:MM:SS]" is ISO 8601 once the slashes are dashes: fromisoformat parses it in C,
+        # without interpreting a format string like strptime does for every call
+        try:
+            return fromisoformat(value.replace("/", "-", 2))
+        except ValueError:
+            pass
+        # Try parsing with a datetime format (e.g. single digit months or days). Adjust the format if needed.
         try:
-            # If a time component is present:
-            if " " in value:
-                return datetime.datetime.strptime(value, "%Y/%m/%d %H:%M:%S")
-            else:
-                return datetime.datetime.strptime(value, "%Y/%m/%d")
+            # The long format is used when a time component is present
+            return strptime(value, DATE_TIME_FORMAT if " " in value else DATE_FORMAT)
         except Exception as e:
             print(f"Error parsing date for column {col_name} with value '{value}': {e}")
             return None
+    return convert
 
-    # Convert numeric fields to float
-    elif col_name in ('valeur', 'valeur_brute', 'taux_de_saisie'):
+
+def make_float_converter(col_name):
+    """
+    Build a converter parsing CSV numeric strings of the given column to floats.
+    """
+    def convert(value):
+        if not value:
+            return None
         try:
             return float(value)
         except Exception as e:
             print(f"Error converting float for column {col_name} with value '{value}': {e}")
             return None
+    return convert
 
-    return value
+
+def make_text_converter(col_name):
+    """
+    Build a converter keeping CSV text values as is (empty strings become None).
+    """
+    intern = sys.intern
+    
+    def convert(value):
+        # Interned so that the many repeated text values share a single string object
+        return intern(value) if value else None
+    return convert
+
+
+# Converter factory for each typed column, every other column is kept as text
+CONVERTER_FACTORIES = {
+    'date_de_debut': make_date_converter,
+    'date_de_fin': make_date_converter,
+    'valeur': make_float_converter,
+    'valeur_brute': make_float_converter,
+    'taux_de_saisie': make_float_converter,
+}
+
+
+# Files larger than this are downloaded with concurrent ranged GET requests
+MULTIPART_THRESHOLD = 8 * 1024 * 1024
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=MULTIPART_THRESHOLD, max_concurrency=8)
+# Downloaded files up to this size are kept in memory, larger ones are written to a temporary file on disk
+SPOOL_MAX_SIZE = 64 * 1024 * 1024
+
+# Files larger than this are parsed with PyArrow, smaller ones with the csv module
+ARROW_MIN_FILE_SIZE = 1024 * 1024
+ARROW_BLOCK_SIZE = 8 * 1024 * 1024
+
+# Prepared insert statements by (keyspace, table name, columns)
+PREPARED_INSERTS = {}
+PREPARED_INSERTS_LOCK = threading.Lock()
+
+# Manifest of the S3 files already loaded, so that unchanged files are not downloaded and parsed again
+# (the curated scripts skip this table when listing the pollutant tables)
+PROCESSED_FILES_TABLE = "processed_files"
+
+# Rows per same-partition batch (kept well under Cassandra's default 50 KB batch size failure threshold)
+BATCH_SIZE = 50
+
+# Arrow type of each typed column, every other column is read as text
+# (float64 rather than float32 to keep the same values as the float() converter)
+ARROW_COLUMN_TYPES = {
+    'date_de_debut': pa.timestamp('ms'),
+    'date_de_fin': pa.timestamp('ms'),
+    'valeur': pa.float64(),
+    'valeur_brute': pa.float64(),
+    'taux_de_saisie': pa.float64(),
+}
+
+
+def get_column_converters(columns):
+    """
+    Resolve once the converter of each column, so that converting a row does not
+    need to branch on the column name for every cell.
+    """
+    return [CONVERTER_FACTORIES.get(col, make_text_converter)(col) for col in columns]
+
+
+def row_fingerprint(row):
+    """
+    Compute a 64-bit fingerprint of a converted row, used as its deduplication key.
+    Storing 8-byte integers instead of the row tuples keeps the deduplication sets small and cheap to hash.
+    Empty cells are None (never ''), so mapping None to '' keeps the fingerprint unambiguous.
+    """
+    return xxh3_64_intdigest('\x1f'.join(['' if value is None else str(value) for value in row]).encode('utf-8'))
 
 
 def create_cassandra_keyspace(session, keyspace):
@@ -112,142 +242,408 @@ def create_cassandra_table(session, table_name):
     session.execute(create_table_query)
 
 
-def get_s3_files(s3, bucket_name, prefix):
+def create_processed_files_table(session):
+    """
+    Create the manifest table recording the S3 files already loaded in staging, with their ETag.
+    """
+    session.execute(f"""
+        CREATE TABLE IF NOT EXISTS {PROCESSED_FILES_TABLE} (
+            key text PRIMARY KEY,
+            etag text,
+            processed_at timestamp
+        );
+    """)
+
+
+def load_processed_files(session):
+    """
+    Load the manifest of processed files as a {key: etag} dictionary (a single query instead of one per file).
+    """
+    rows = session.execute(f"SELECT key, etag FROM {PROCESSED_FILES_TABLE}")
+    return {row.key: row.etag for row in rows}
+
+
+def record_processed_files(session, files):
+    """
+    Record the given S3 files (with their current ETag) in the manifest of processed files.
+    """
+    prepared = session.prepare(
+        f"INSERT INTO {PROCESSED_FILES_TABLE} (key, etag, processed_at) VALUES (?, ?, toTimestamp(now()))"
+    )
+    params = [(file_obj["Key"], file_obj.get("ETag")) for file_obj in files]
+    results = execute_concurrent_with_args(session, prepared, params, concurrency=64, raise_on_first_error=False)
+    
+    # Every write is attempted, then a failure is raised: a file missing from the manifest would be loaded again on the next run
+    failed = [(key, result) for (key, _), (success, result) in zip(params, results) if not success]
+    for key, error in failed:
+        print(f"Error recording processed file {key}: {error}")
+    if failed:
+        raise RuntimeError(f"{len(failed)} processed file(s) could not be recorded in the manifest")
+
+
+def list_s3_prefix(s3, bucket_name, prefix):
+    """
+    List all the files directly under the given prefix (following pagination) and its sub-prefixes.
+    """
+    files = []
+    sub_prefixes = []
+    paginator = s3.get_paginator("list_objects_v2")
+    pages = paginator.paginate(Bucket=bucket_name, Prefix=prefix, Delimiter="/", PaginationConfig={"PageSize": 1000})
+    for page in pages:
+        files.extend(page.get("Contents", []))
+        sub_prefixes.extend(common_prefix["Prefix"] for common_prefix in page.get("CommonPrefixes", []))
+    return files, sub_prefixes
+
+
+def get_s3_files(s3, bucket_name, prefix, max_workers=16):
     """
     Get list of files from S3 with the given prefix/key/particle_code.
+    Sub-prefixes (e.g. year/month folders) are listed in parallel, level by level.
     """
-    response = s3.list_objects_v2(Bucket=bucket_name, Prefix=prefix)
-    if "Contents" not in response:
-        return []
-    return response["Contents"]
+    files, sub_prefixes = list_s3_prefix(s3, bucket_name, prefix)
+    if not sub_prefixes:
+        return files
+    
+    # boto3 clients are thread safe so the listing threads can share the same client
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while sub_prefixes:
+            results = list(executor.map(lambda sub_prefix: list_s3_prefix(s3, bucket_name, sub_prefix), sub_prefixes))
+            sub_prefixes = []
+            for sub_files, nested_prefixes in results:
+                files.extend(sub_files)
+                sub_prefixes.extend(nested_prefixes)
+    return files
+
+
+def read_csv_with_arrow(stream):
+    """
+    Parse a CSV stream with PyArrow (multithreaded), converting the typed columns while parsing.
+    Yields the normalized header first, then the non-empty unique rows as tuples of Python values.
+    """
+    # Header names are normalized first so that column types can be given per normalized column
+    header_line = stream.readline().decode("utf-8")
+    if not header_line.strip():
+        return
+    header = next(csv.reader([header_line], delimiter=';'))
+    normalized_header = [normalize_column_name(col) for col in header]
+    
+    # PyArrow refuses an empty CSV, a file with a header only has no rows
+    if not stream.peek(1):
+        yield normalized_header
+        return
+    
+    # The table is fully parsed before yielding anything, so a parsing error leaves the caller with no rows
+    table = pa_csv.read_csv(
+        stream,
+        read_options=pa_csv.ReadOptions(column_names=normalized_header, block_size=ARROW_BLOCK_SIZE, use_threads=True),
+        parse_options=pa_csv.ParseOptions(delimiter=';'),
+        convert_options=pa_csv.ConvertOptions(
+            column_types={col: ARROW_COLUMN_TYPES.get(col, pa.string()) for col in normalized_header},
+            timestamp_parsers=[DATE_TIME_FORMAT, DATE_FORMAT],
+            null_values=[""],
+            strings_can_be_null=True
+        )
+    )
+    
+    # Drop rows where every cell is empty
+    non_empty = pc.is_valid(table.column(0))
+    for column in table.columns[1:]:
+        non_empty = pc.or_(non_empty, pc.is_valid(column))
+    table = table.filter(non_empty)
+    
+    # Drop duplicate rows on the Arrow columns (grouping on every column without aggregation)
+    table = table.group_by(normalized_header, use_threads=False).aggregate([])
+    
+    yield normalized_header
+    yield from zip(*[column.to_pylist() for column in table.columns])
+
+
+def read_csv_with_converters(stream):
+    """
+    Parse a CSV stream row by row, converting each cell with its column converter.
+    Slower than PyArrow but tolerant to malformed values (converted to None).
+    Yields the normalized header first, then the non-empty rows as tuples of Python values.
+    """
+    reader = csv.reader(io.TextIOWrapper(stream, encoding="utf-8", newline=""), delimiter=';')
+    header = next(reader, None)
+    if header is None:
+        return
+    normalized_header = [normalize_column_name(col) for col in header]
+    converters = get_column_converters(normalized_header)
+    
+    yield normalized_header
+    for row in reader:
+        # One C-level join per row instead of a generator step per cell, isspace() avoids building a stripped copy
+        joined = ''.join(row)
+        if joined and not joined.isspace():
+            yield tuple(convert(value) for convert, value in zip(converters, row))
+
+
+def read_csv_with_pandas(stream):
+    """
+    Parse a CSV stream with the pandas C engine, converting the typed columns column by column.
+    Malformed values become None (like the converters) instead of failing the whole file as PyArrow does.
+    Yields the normalized header first, then the non-empty unique rows as tuples of Python values.
+    """
+    header_line = stream.readline().decode("utf-8")
+    if not header_line.strip():
+        return
+    header = next(csv.reader([header_line], delimiter=';'))
+    normalized_header = [normalize_column_name(col) for col in header]
+    
+    yield normalized_header
+    if not stream.peek(1):
+        return
+    
+    # Everything is read as text first, only empty cells are missing values (a value such as "NA" stays text)
+    df = pd.read_csv(
+        stream,
+        sep=';',
+        header=None,
+        names=normalized_header,
+        dtype=str,
+        engine='c',
+        keep_default_na=False,
+        na_values=[""]
+    )
+    df = df.dropna(how='all')
+    
+    # Vectorized conversions, invalid values are coerced to NaN/NaT
+    for col in normalized_header:
+        column_type = ARROW_COLUMN_TYPES.get(col)
+        if column_type is None:
+            continue
+        if pa.types.is_timestamp(column_type):
+            dates = pd.to_datetime(df[col], format=DATE_TIME_FORMAT, errors='coerce')
+            df[col] = dates.fillna(pd.to_datetime(df[col], format=DATE_FORMAT, errors='coerce'))
+        else:
+            df[col] = pd.to_numeric(df[col], errors='coerce')
+    
+    df = df.drop_duplicates()
+    
+    # Python objects for the Cassandra driver, missing values (NaN/NaT) become None
+    df = df.astype(object).where(df.notna(), None)
+    yield from df.itertuples(index=False, name=None)
 
 
-def process_s3_file(s3, bucket_name, key):
+def open_s3_file(s3, bucket_name, key, size=0):
     """
-    Read and parse a CSV file from S3 bucket.
+    Open a file from S3 bucket as a buffered binary stream.
+    Large files are downloaded with concurrent ranged GET requests, others are streamed.
+    A downloaded file above SPOOL_MAX_SIZE goes to an anonymous temporary file (deleted once closed)
+    instead of memory, several of them are downloaded at the same time by the worker threads.
     """
+    if size > SPOOL_MAX_SIZE:
+        tmp = tempfile.TemporaryFile()
+        s3.download_fileobj(bucket_name, key, tmp, Config=TRANSFER_CONFIG)
+        tmp.seek(0)
+        return tmp
+    if size > MULTIPART_THRESHOLD:
+        buffer = io.BytesIO()
+        s3.download_fileobj(bucket_name, key, buffer, Config=TRANSFER_CONFIG)
+        buffer.seek(0)
+        return io.BufferedReader(buffer)
     obj_response = s3.get_object(Bucket=bucket_name, Key=key)
-    content = obj_response["Body"].read().decode("utf-8")
-    reader = csv.reader(io.StringIO(content), delimiter=';')
-    return list(reader)
+    return io.BufferedReader(obj_response["Body"])
+
+
+def process_s3_file(s3, bucket_name, key, size=0):
+    """
+    Read and parse a CSV file from S3 bucket without loading its whole content first.
+    Yields the normalized header first, then the converted data rows (nothing for an empty file).
+    Small files are parsed with the csv module, as PyArrow's fixed startup cost outweighs its speed on them.
+    """
+    # Each stream is closed as soon as its parser is done (a temporary file is deleted then), not left to the garbage collector
+    if size <= ARROW_MIN_FILE_SIZE:
+        with open_s3_file(s3, bucket_name, key, size) as stream:
+            yield from read_csv_with_converters(stream)
+        return
+    
+    try:
+        with open_s3_file(s3, bucket_name, key, size) as stream:
+            yield from read_csv_with_arrow(stream)
+    except pa.ArrowInvalid as e:
+        # The stream has been consumed by PyArrow (and is closed now), the file is downloaded again for the fallback
+        print(f"Falling back to pandas parsing for file {key}: {e}")
+        with open_s3_file(s3, bucket_name, key, size) as stream:
+            yield from read_csv_with_pandas(stream)
+
+
+def get_prepared_insert(session, table_name, columns):
+    """
+    Get the prepared insert statement of a table, preparing it on first use.
+    Statements are cached so that each insert statement is prepared only once.
+    The cache key includes the keyspace and the column list, so a table read with another header gets its own statement.
+    """
+    cache_key = (session.keyspace, table_name, tuple(columns))
+    with PREPARED_INSERTS_LOCK:
+        prepared = PREPARED_INSERTS.get(cache_key)
+        if prepared is None:
+            # No IF NOT EXISTS: a plain INSERT is idempotent on the primary key and avoids a lightweight transaction per row
+            insert_columns = ", ".join(columns)
+            placeholders = ", ".join(["?"] * len(columns))
+            insert_query = f"INSERT INTO {table_name} ({insert_columns}) VALUES ({placeholders})"
+            prepared = session.prepare(insert_query)
+            prepared.consistency_level = ConsistencyLevel.LOCAL_ONE
+            PREPARED_INSERTS[cache_key] = prepared
+    return prepared
 
 
-def batch_insert_data_into_cassandra(session, table_name, columns, data, batch_size=100):
+def group_rows_into_partition_batches(prepared, columns, data):
     """
-    Insert data rows into the Cassandra table in batches.
+    Group the rows by partition key (code_site) into UNLOGGED batches of at most BATCH_SIZE rows.
+    Each batch only touches one partition, so it is applied by a single replica without coordinator fan-out.
+    
+    Returns:
+        List of (batch, number of rows in the batch) tuples
+    """
+    code_site_index = columns.index("code_site")
+    rows_by_site = {}
+    for row in data:
+        rows_by_site.setdefault(row[code_site_index], []).append(row)
+    
+    batches = []
+    for site_rows in rows_by_site.values():
+        for start in range(0, len(site_rows), BATCH_SIZE):
+            chunk = site_rows[start:start + BATCH_SIZE]
+            batch = BatchStatement(batch_type=BatchType.UNLOGGED, consistency_level=ConsistencyLevel.LOCAL_ONE)
+            for row in chunk:
+                batch.add(prepared, row)
+            batches.append((batch, len(chunk)))
+    return batches
+
+
+def batch_insert_data_into_cassandra(session, table_name, columns, data, concurrency=64):
+    """
+    Insert data rows into the Cassandra table with concurrent same-partition UNLOGGED batches.
     
     Args:
         table_name: Target table name
         columns: List of column names
-        data: List of data rows to insert
-        batch_size: Number of rows to insert in each batch
-    """
-    # Prepare the insert query
-    insert_columns = ", ".join(columns)
-    placeholders = ", ".join(["?"] * len(columns))
-    insert_query = f"INSERT INTO {table_name} ({insert_columns}) VALUES ({placeholders}) IF NOT EXISTS"
-    prepared = session.prepare(insert_query)
-    
-    # Process in batches to improve performance
-    total_rows = len(data)
-    
-    for i in range(0, total_rows, batch_size):
-        # Calculate the end index for current batch
-        batch_end = min(i + batch_size, total_rows)
-        batch = data[i:batch_end]
+        data: List of converted data rows to insert
+        concurrency: Maximum number of batches executed concurrently by the driver
+        
+    Returns:
+        Number of rows that failed to be inserted
+    """
+    prepared = get_prepared_insert(session, table_name, columns)
+    
+    if "code_site" not in columns:
+        # Without the partition key the rows cannot be grouped, insert them one by one
+        results = execute_concurrent_with_args(session, prepared, data, concurrency=concurrency, raise_on_first_error=False)
+        errors = [result for success, result in results if not success]
+        if errors:
+            print(f"  - Failed to insert {len(errors)}/{len(data)} rows into {table_name}: {errors[0]}")
+        print(f"  - Inserted {len(data) - len(errors)}/{len(data)} rows into {table_name}")
+        return len(errors)
+    
+    batches = group_rows_into_partition_batches(prepared, columns, data)
+    
+    # The driver keeps at most `concurrency` batches in flight and, with a token aware policy, sends each batch to a replica owning its partition
+    statements_and_params = ((batch, None) for batch, _ in batches)
+    results = execute_concurrent(session, statements_and_params, concurrency=concurrency, raise_on_first_error=False)
+    
+    failed_rows = 0
+    first_error = None
+    for (success, result), (_, batch_rows) in zip(results, batches):
+        if not success:
+            failed_rows += batch_rows
+            first_error = first_error or result
+    if failed_rows:
+        print(f"  - Failed to insert {failed_rows}/{len(data)} rows into {table_name}: {first_error}")
+    print(f"  - Inserted {len(data) - failed_rows}/{len(data)} rows into {table_name} ({len(batches)} batches)")
+    return failed_rows
+
+
+def process_file(s3, bucket_name, file_obj):
+    """
+    Process a single S3 file in a worker thread.
+    Returns the normalized header, unique rows from this file and their fingerprints.
+    """
+    key = file_obj["Key"]
+    try:
+        # Stream and parse the file (header is normalized, empty rows are dropped)
+        rows = process_s3_file(s3, bucket_name, key, file_obj.get("Size", 0))
+        normalized_header = next(rows, None)
+        if normalized_header is None:
+            return None, [], []
         
-        # Process each row in the current batch
-        for row in batch:
-            # Convert each value in the row using the column name
-            converted_row = [convert_value(col, value) for col, value in zip(columns, row)]
-            session.execute(prepared, converted_row)
+        # Filter out duplicate rows within this file with a set local to this thread
+        # (fingerprints are computed here, in parallel, and reused by the merge)
+        local_seen = set()
+        unique_rows = []
+        fingerprints = []
+        for row in rows:
+            fingerprint = row_fingerprint(row)
+            if fingerprint not in local_seen:
+                local_seen.add(fingerprint)
+                unique_rows.append(row)
+                fingerprints.append(fingerprint)
         
-        # Log progress at regular intervals or at the end
-        if (i + batch_size) % 2000 == 0 or batch_end == total_rows:
-            print(f"  - Inserted {batch_end}/{total_rows} rows into {table_name}")
+        return normalized_header, unique_rows, fingerprints
+    except Exception as e:
+        print(f"Error processing file {key}: {e}")
+        return None, [], []
 
 
-def process_s3_files_parallel(files, s3, bucket_name, max_workers=4):
+def process_s3_files_parallel(files_by_table, s3, bucket_name, max_workers=16):
     """
-    Process S3 files in parallel using thread pool.
+    Process the S3 files of all the pollutants in parallel using a single thread pool.
     
     Args:
-        files: List of S3 file objects to process
+        files_by_table: Dictionary of the S3 file objects to process by table name
         s3: S3 client
         bucket_name: S3 bucket name
         max_workers: Maximum number of worker threads to use
         
     Returns:
-        Tuple of (normalized_header, all_rows)
+        Dictionary of (normalized_header, all_rows, read_files) tuples by table name,
+        where read_files are the file objects whose rows were kept
     """
-    header_normalized = None
-    all_rows = []
-    # Use a set to track seen rows for deduplication across threads
-    seen = set()
+    results = {table_name: (None, [], []) for table_name in files_by_table}
+    # Use a set per table to track the fingerprints of seen rows for deduplication across files
+    # Only the main thread merging the results uses them, so no lock is needed
+    seen_by_table = {table_name: set() for table_name in files_by_table}
     
-    # Create a lock for thread-safe operations on shared data structures (prevents race conditions)
-    lock = threading.Lock()
-    
-    def process_file(file_obj):
-        """
-        Inner function to process a single S3 file in a worker thread.
-        Returns the normalized header and unique rows from this file.
-        """
-        key = file_obj["Key"]
-        try:
-            # Download and parse the file
-            rows = process_s3_file(s3, bucket_name, key)
-            if not rows:
-                return None, []
-            
-            # Normalize header names
-            header = rows[0]
-            normalized_header = [normalize_column_name(col) for col in header]
-            
-            # Filter out duplicate rows within this file
-            unique_rows = []
-            for row in rows[1:]:
-                if row and any(cell.strip() for cell in row):
-                    row_tuple = tuple(row)
-                    # Use lock to safely check and update the seen set
-                    with lock:
-                        if row_tuple not in seen:
-                            seen.add(row_tuple)
-                            unique_rows.append(row)
-            
-            return normalized_header, unique_rows
-        except Exception as e:
-            print(f"Error processing file {key}: {e}")
-            return None, []
-    
-    # Create a ThreadPoolExecutor with the specified number of workers
-    # ThreadPoolExecutor manages a pool of worker threads for concurrent execution
-    # This is ideal for I/O-bound tasks like file processing
+    # A single ThreadPoolExecutor for the files of every pollutant (no nested pools)
+    # This is ideal for I/O-bound tasks like file processing and keeps the number of threads bounded
     with ThreadPoolExecutor(max_workers=max_workers) as executor:
         # Submit all file processing tasks to the executor
         # Each file will be processed in a separate thread from the pool
-        futures = [executor.submit(process_file, file_obj) for file_obj in files]
+        futures = {
+            executor.submit(process_file, s3, bucket_name, file_obj): (table_name, file_obj)
+            for table_name, files in files_by_table.items()
+            for file_obj in files
+        }
         
         # Process results as they complete
         # as_completed yields futures as they finish, regardless of submission order
         # This allows us to process results as soon as they're available
         for future in as_completed(futures):
-            result_header, result_rows = future.result()
+            table_name, file_obj = futures[future]
+            result_header, result_rows, result_fingerprints = future.result()
             
             if result_header is None:
                 continue
-                
-            # Thread-safe update of the shared result variables
-            with lock:
-                if header_normalized is None:
-                    # First valid result sets the header standard
-                    header_normalized = result_header
-                    all_rows = result_rows
-                elif result_header == header_normalized:
-                    # If header matches our standard, add the rows
-                    all_rows.extend(result_rows)
+            
+            header_normalized, all_rows, read_files = results[table_name]
+            if header_normalized is None:
+                # First valid result of the table sets the header standard
+                header_normalized = result_header
+                results[table_name] = (header_normalized, all_rows, read_files)
+            elif result_header != header_normalized:
+                print(f"Header mismatch in file {file_obj['Key']}. Skipping file.")
+                continue
+            read_files.append(file_obj)
+            
+            # If header matches our standard, add the rows not seen in previous files
+            seen = seen_by_table[table_name]
+            for row, fingerprint in zip(result_rows, result_fingerprints):
+                if fingerprint not in seen:
+                    seen.add(fingerprint)
+                    all_rows.append(row)
     
-    return header_normalized, all_rows
+    return results
 
 
 def process_file_batches(s3, bucket_name, file_batch, pollutant_short_name):
@@ -275,15 +671,12 @@ def process_file_batches(s3, bucket_name, file_batch, pollutant_short_name):
         print(f"  - Processing file: {key}")
         
         try:
-            rows = process_s3_file(s3, bucket_name, key)
+            rows = process_s3_file(s3, bucket_name, key, obj.get("Size", 0))
+            normalized_header = next(rows, None)
             
-            if not rows:
+            if normalized_header is None:
                 continue
             
-            # Normalize header names
-            header = rows[0]
-            normalized_header = [normalize_column_name(col) for col in header]
-            
             if header_normalized is None:
                 header_normalized = normalized_header
             elif normalized_header != header_normalized:
@@ -292,9 +685,10 @@ def process_file_batches(s3, bucket_name, file_batch, pollutant_short_name):
             
             # Add non-empty data rows and skip duplicates
             batch_data = []
-            for row in rows[1:]:
-                if row and any(cell.strip() for cell in row) and tuple(row) not in seen:
-                    seen.add(tuple(row))
+            for row in rows:
+                fingerprint = row_fingerprint(row)
+                if fingerprint not in seen:
+                    seen.add(fingerprint)
                     batch_data.append(row)
             
             batch_results.extend(batch_data)
@@ -305,34 +699,21 @@ def process_file_batches(s3, bucket_name, file_batch, pollutant_short_name):
     return header_normalized, batch_results
 
 
-def process_pollutant_parallel(pollutant, s3, cluster, bucket_name, keyspace, max_workers=4, batch_size=100):
+def list_pollutant_files(pollutant, s3, bucket_name, processed_files):
     """
-    Process a single pollutant's data files in parallel.
-    
-    This function handles the complete parallel processing pipeline for one pollutant:
-    1. Creates a dedicated Cassandra session
-    2. Lists all S3 files for the pollutant
-    3. Processes files in parallel using multiple threads
-    4. Inserts the results into Cassandra
+    List the new or changed S3 files of a pollutant.
     
     Args:
         pollutant: Pollutant configuration dictionary (check config/pollutants.yaml)
         s3: S3 client
-        cluster: Cassandra cluster connection
         bucket_name: S3 bucket name
-        keyspace: Cassandra keyspace name
-        max_workers: Maximum number of worker threads for file processing
-        batch_size: Number of rows to insert in each Cassandra batch
+        processed_files: Manifest of the files already loaded ({key: etag}), unchanged files are skipped
+        
+    Returns:
+        List of the S3 file objects to process
     """
     pollutant_code = pollutant["code"]
     pollutant_short_name = pollutant["short_name"]
-    table_name = normalize_column_name(pollutant_short_name)
-    
-    print(f"\n=== Processing pollutant: {pollutant_short_name} (Code: {pollutant_code}) ===")
-    
-    # Create a dedicated session for this pollutant processing
-    # This avoids contention with other pollutant processing threads
-    session = cluster.connect(keyspace)
     
     # List all objects in S3 for the given pollutant folder/key
     prefix = f"{pollutant_code}/"
@@ -340,28 +721,48 @@ def process_pollutant_parallel(pollutant, s3, cluster, bucket_name, keyspace, ma
     
     if not files:
         print(f"No files found in S3 for pollutant {pollutant_short_name}.")
-        return
+        return []
     
     print(f"Found {len(files)} files for pollutant {pollutant_short_name}.")
     
-    # Create Cassandra table
-    create_cassandra_table(session, table_name)
-    print(f"Created table {table_name}.")
-    
-    # Process files in parallel using the thread pool
-    # Distributing file processing across multiple threads to maximize I/O throughput
-    header_normalized, all_rows = process_s3_files_parallel(files, s3, bucket_name, max_workers)
+    # Skip the files already loaded whose content did not change since (same ETag)
+    files = [file_obj for file_obj in files if processed_files.get(file_obj["Key"]) != file_obj.get("ETag")]
+    if not files:
+        print(f"No new or changed files for pollutant {pollutant_short_name}.")
+        return []
+    print(f"{len(files)} new or changed files for pollutant {pollutant_short_name}.")
+    return files
+
+
+def insert_pollutant_rows(session, table_name, header_normalized, all_rows, read_files, concurrency=64):
+    """
+    Insert the unique rows read for a pollutant and record its files in the manifest.
     
+    Args:
+        session: Cassandra session
+        table_name: Target table name
+        header_normalized: Normalized header of the pollutant's files
+        all_rows: Unique converted rows of the pollutant's files
+        read_files: File objects whose rows were kept
+        concurrency: Maximum number of concurrent Cassandra insert batches
+    """
     if not header_normalized or not all_rows:
-        print(f"No data rows found for pollutant {pollutant_short_name}.")
+        print(f"No data rows found for table {table_name}.")
+        # Files read without any new row are recorded too, so they are not read again
+        if read_files:
+            record_processed_files(session, read_files)
         return
     
-    print(f"Total unique rows for {pollutant_short_name}: {len(all_rows)}")
+    print(f"Total unique rows for {table_name}: {len(all_rows)}")
     
-    # Insert data in batches
-    # This improves throughput by reducing the number of network round-trips while still showing progress updates
-    batch_insert_data_into_cassandra(session, table_name, header_normalized, all_rows, batch_size)
+    # Insert data with concurrent requests
+    # This improves throughput by overlapping the network round-trips
+    failed_rows = batch_insert_data_into_cassandra(session, table_name, header_normalized, all_rows, concurrency)
     print(f"Insertion into table '{table_name}' done.")
+    
+    # Only a complete load marks the files as processed, otherwise they are read again on the next run
+    if failed_rows == 0:
+        record_processed_files(session, read_files)
 
 
 def main():
@@ -369,59 +770,76 @@ def main():
 
     # Load config variables from config/config.yaml
     with open("config/config.yaml", "r") as f:
-        config = yaml.safe_load(f)
+        config = yaml.load(f, Loader=SafeLoader)
     with open("config/pollutants.yaml", "r") as f:
-        pollutants = yaml.safe_load(f)
+        pollutants = yaml.load(f, Loader=SafeLoader)
 
     # Get AWS credentials from config
     aws_access_key_id = config["s3"]["aws_access_key_id"]
     aws_secret_access_key = config["s3"]["aws_secret_access_key"]
 
     # Connect to s3
+    # The client is shared by all the download threads, so its connection pool must be large enough for them
     s3 = boto3.client(
         "s3",
         endpoint_url=config["s3"]["endpoint_url"],
         aws_access_key_id=aws_access_key_id,
-        aws_secret_access_key=aws_secret_access_key
+        aws_secret_access_key=aws_secret_access_key,
+        config=Config(max_pool_connections=64, retries={"max_attempts": 10, "mode": "adaptive"})
     )
     bucket_name = config["s3"]["bucket_name"]
 
     # Connect to Cassandra
-    cluster = Cluster([config["cassandra"]["host"]], port=config["cassandra"]["port"])
+    # Token aware routing sends each request straight to a replica of its partition, skipping a coordinator hop
+    cluster = Cluster(
+        [config["cassandra"]["host"]],
+        port=config["cassandra"]["port"],
+        load_balancing_policy=TokenAwarePolicy(DCAwareRoundRobinPolicy()),
+        protocol_version=4
+    )
     session = cluster.connect()
     keyspace = config["cassandra"]["keyspace"]
     
-    # Create keyspace if it does not exist
+    # Prepared statements belong to the cluster they were prepared on, drop those left by a previous run in the same worker process
+    with PREPARED_INSERTS_LOCK:
+        PREPARED_INSERTS.clear()
+    
+    # Create keyspace if it does not exist (and use it for the session)
     create_cassandra_keyspace(session, keyspace)
     
+    # Load the manifest of the files processed by previous runs
+    create_processed_files_table(session)
+    processed_files = load_processed_files(session)
+    
     # Set the number of worker threads
-    max_workers = 4 # (for first level parallelism: processing multiple pollutants)
-    batch_size = 100 
-    
-    # Process pollutants in parallel using a ThreadPoolExecutor
-    # - Each pollutant is processed in its own thread
-    # - Each pollutant's files are processed in parallel within that thread
-    # - This creates a two-level parallel execution structure
-    with ThreadPoolExecutor(max_workers=min(len(pollutants), max_workers)) as executor:
-        # Submit each pollutant processing as a separate task
-        # limit max_workers to the number of pollutants to avoid creating unnecessary threads
-        futures = [executor.submit(
-            process_pollutant_parallel, 
-            pollutant, 
-            s3, 
-            cluster, 
-            bucket_name, 
-            keyspace, 
-            max_workers=2,  # Workers per pollutant processing (second-level parallelism : processing multiple files)
-            batch_size=batch_size
-        ) for pollutant in pollutants]
-        
-        # Wait for all tasks to complete and handle any exceptions as_completed yields futures as they finish, regardless of submission order
-        for future in as_completed(futures):
-            try:
-                future.result()
-            except Exception as e:
-                print(f"Error in pollutant processing: {e}")
+    max_workers = 16 # Threads downloading and parsing the files of all the pollutants (hide S3 latency)
+    concurrency = 64 # Concurrent Cassandra insert batches
+    
+    # List the files to process and create the table of each pollutant
+    files_by_table = {}
+    for pollutant in pollutants:
+        print(f"\n=== Processing pollutant: {pollutant['short_name']} (Code: {pollutant['code']}) ===")
+        files = list_pollutant_files(pollutant, s3, bucket_name, processed_files)
+        if not files:
+            continue
+        table_name = normalize_column_name(pollutant["short_name"])
+        create_cassandra_table(session, table_name)
+        print(f"Created table {table_name}.")
+        files_by_table[table_name] = files
+    
+    # Process the files of all the pollutants with a single flat thread pool
+    # (one task per file instead of a pool per pollutant, so the threads do not multiply)
+    results = process_s3_files_parallel(files_by_table, s3, bucket_name, max_workers=max_workers)
+    
+    # Insert each pollutant's rows (the driver already keeps many batches in flight for each table)
+    for table_name, (header_normalized, all_rows, read_files) in results.items():
+        try:
+            insert_pollutant_rows(session, table_name, header_normalized, all_rows, read_files, concurrency)
+        except Exception as e:
+            print(f"Error in pollutant processing: {e}")
+    
+    # Close the Cassandra connections (the script may run inside a long-lived Airflow worker)
+    cluster.shutdown()
     
     # Calculate and report the total execution time
     elapsed_time = time.time() - start_time
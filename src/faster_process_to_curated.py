@@ -1,36 +1,105 @@
 import os
+import csv
+import io
 import yaml
 import pandas as pd
 import numpy as np
+import numexpr as ne
 import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from numba import njit, prange
 from cassandra.cluster import Cluster
+from cassandra.query import tuple_factory
 from sqlalchemy import create_engine
 
 
+# Manifest of the files loaded by the staging step, not a pollutant table
+PROCESSED_FILES_TABLE = "processed_files"
+# Rows fetched per page when loading a table
+FETCH_SIZE = 5000
+
+
+# fastmath without "nnan" (NaN values are expected and tested) and "ninf"
+@njit(parallel=True, cache=True, fastmath={"nsz", "arcp", "contract", "afn", "reassoc"})
+def rowsum_skipna(values):
+    """
+    Sum each row of a 2-D float32 array, skipping NaN values (a row with only NaN sums to 0).
+    The NaN check and the sum are done in the same pass over the array, rows are split between threads.
+    The sum is accumulated in float32 (a few g/L values per row) and returned as float64.
+    """
+    out = np.zeros(values.shape[0])
+    for i in prange(values.shape[0]):
+        total = np.float32(0.0)
+        for j in range(values.shape[1]):
+            value = values[i, j]
+            # NaN is the only value not equal to itself (kept since "nnan" is not in the fastmath flags)
+            if value == value:
+                total += value
+        out[i] = total
+    return out
+
+
+@njit(parallel=True, cache=True, error_model="numpy")
+def diff_and_percent_change(values, groups, periods):
+    """
+    Compute, for each column of a 2-D float64 array, the difference and the percentage change
+    between each value and the value `periods` rows before in the same group, in a single pass over the array.
+    Rows must be sorted by group. The first `periods` rows of a group have a difference of 0 (compared to themselves)
+    and no percentage change (NaN).
+    Division by zero gives inf/NaN like NumPy (error_model="numpy") instead of raising.
+    """
+    n_rows, n_cols = values.shape
+    diff = np.empty_like(values)
+    percent_change = np.empty_like(values)
+    for j in prange(n_cols):
+        for i in range(n_rows):
+            if i >= periods and groups[i - periods] == groups[i]:
+                previous = values[i - periods, j]
+                diff[i, j] = values[i, j] - previous
+                percent_change[i, j] = (values[i, j] - previous) / previous * 100.0
+            else:
+                diff[i, j] = 0.0 if values[i, j] == values[i, j] else np.nan
+                percent_change[i, j] = np.nan
+    return diff, percent_change
+
+
 def list_tables(session, keyspace):
     """
-    List all tables in the given keyspace.
+    List all pollutant tables in the given keyspace.
     """
-    query = f"SELECT table_name FROM system_schema.tables WHERE keyspace_name = '{keyspace}'"
-    rows = session.execute(query)
-    table_names = [row.table_name for row in rows]
+    # The keyspace is bound as a parameter of a prepared statement rather than formatted into the query
+    query = session.prepare("SELECT table_name FROM system_schema.tables WHERE keyspace_name = ?")
+    rows = session.execute(query, (keyspace,))
+    # The session returns plain tuples (tuple_factory), table_name is the only selected column
+    table_names = [row[0] for row in rows if row[0] != PROCESSED_FILES_TABLE]
     return table_names
 
 
-def load_table_to_dataframe(session, table_name):
+def result_to_dataframe(rows):
     """
-    Load all rows from a Cassandra table into a pandas DataFrame.
+    Build a pandas DataFrame from a Cassandra result set, fetching its remaining pages.
+    Rows are read page by page as plain tuples (session.row_factory = tuple_factory) and
+    appended to one list per column, so the full table is never held as a list of Row objects.
     """
-    query = f"SELECT * FROM {table_name}"
-    rows = session.execute(query)
-    df = pd.DataFrame(list(rows))
+    columns = {name: [] for name in rows.column_names}
+    column_lists = list(columns.values())
+    while True:
+        page = rows.current_rows
+        if page:
+            for column_list, values in zip(column_lists, zip(*page)):
+                column_list.extend(values)
+        if not rows.has_more_pages:
+            break
+        rows.fetch_next_page()
+    df = pd.DataFrame(columns)
     return df
 
 
 def convert_units(df):
     """
     Convert pollutant values from their given units to g/L based on the unit column.
-    Uses NumPy for efficient operations.
+    Uses NumPy and NumExpr for efficient operations.
     """
     # Define conversion factors for each unit.
     unit_conversion = {
@@ -39,6 +108,8 @@ def convert_units(df):
         "ng-m3": 1e-9,  # Nanograms per cubic meter to g/L
     }
     
+    factors = np.append(np.array(list(unit_conversion.values())), np.nan)
+    
     # Detect unit columns dynamically
     unit_columns = [col for col in df.columns if col.endswith("_unite_de_mesure")]
     
@@ -54,28 +125,51 @@ def convert_units(df):
             # Backward-fill missing values in unit column
             df.loc[:, unit_column] = df[unit_column].bfill()
         
-        # Convert units using NumPy vectorized operations
-        conversion_factors = df[unit_column].map(unit_conversion).values
+        # Convert units using NumPy vectorized operations: the category codes index the factors array
+        # (unknown units get the code -1, which picks the NaN appended at the end)
+        units = pd.Categorical(df[unit_column], categories=list(unit_conversion))
+        conversion_factors = factors[units.codes]
         
-        for value_suffix in ["_valeur", "_valeur_brute"]:
-            value_col = f"{table_prefix}{value_suffix}"
-            if value_col in df.columns:
-                df.loc[:, f"{value_col}_g_par_L"] = df[value_col].values * conversion_factors
+        value_cols = [f"{table_prefix}{value_suffix}" for value_suffix in ["_valeur", "_valeur_brute"] if f"{table_prefix}{value_suffix}" in df.columns]
+        if value_cols:
+            # Multiply all the value columns of the table in one NumExpr pass (blocked and multithreaded, no temporaries).
+            # The g/L values are stored in float32 (about 7 significant digits), which halves the memory read by the next steps.
+            values = df[value_cols].to_numpy(dtype=np.float32)
+            converted = ne.evaluate("values * conversion_factors", local_dict={"values": values, "conversion_factors": conversion_factors[:, None].astype(np.float32)})
+            for i, value_col in enumerate(value_cols):
+                df[f"{value_col}_g_par_L"] = converted[:, i]
     
     return df
 
 
-def aggregate_valeurs(df):
+def classify_columns(columns):
+    """
+    Sort the column names of the merged DataFrame in a single pass.
+    Returns the '_valeur' columns (excluding those ending with '_type_de_valeur'),
+    the '_valeur_g_par_L' columns and the '_valeur_brute_g_par_L' columns.
+    """
+    value_columns, valeur_columns, valeur_brute_columns = [], [], []
+    for col in columns:
+        if col.endswith("_valeur_g_par_L"):
+            valeur_columns.append(col)
+        elif col.endswith("_valeur_brute_g_par_L"):
+            valeur_brute_columns.append(col)
+        elif col.endswith("_valeur") and not col.endswith("_type_de_valeur"):
+            value_columns.append(col)
+    return value_columns, valeur_columns, valeur_brute_columns
+
+
+def aggregate_valeurs(df, valeur_columns=None, valeur_brute_columns=None):
     """
     Aggregate all columns ending with '_valeur_g_par_L' (excluding those ending with '_type_de_valeur')
-    and columns ending with '_valeur_brute_g_par_L' into a new column 'total_valeur_particule_g_par_L' using NumPy.
+    and columns ending with '_valeur_brute_g_par_L' into a new column 'total_valeur_particule_g_par_L' using a Numba kernel.
     """
-    valeur_columns = [col for col in df.columns if col.endswith("_valeur_g_par_L") and not col.endswith("_type_de_valeur")]
-    valeur_brute_columns = [col for col in df.columns if col.endswith("_valeur_brute_g_par_L")]
+    if valeur_columns is None or valeur_brute_columns is None:
+        _, valeur_columns, valeur_brute_columns = classify_columns(df.columns)
     cols = valeur_columns + valeur_brute_columns
     
     if cols:
-        df.loc[:, "total_valeur_particule_g_par_L"] = np.nansum(df[cols].values, axis=1)
+        df.loc[:, "total_valeur_particule_g_par_L"] = rowsum_skipna(df[cols].to_numpy(dtype=np.float32, copy=False))
     else:
         df["total_valeur_particule_g_par_L"] = np.nan
     
@@ -86,61 +180,37 @@ def replace_null_values_by_mean(df):
     """
     Replace null numeric values with the mean of their respective column.
     """
-    numeric_cols = df.select_dtypes(include='number').columns
-    for col in numeric_cols:
-        mean_val = df[col].mean()
-        df[col] = df[col].fillna(mean_val)
+    numeric_df = df.select_dtypes(include='number')
+    # fillna with the Series of column means fills every numeric column in one call
+    df[numeric_df.columns] = numeric_df.fillna(numeric_df.mean())
     return df
 
 
-def shift_and_calculate_diff_6_hours_ago(df):
+def shift_and_calculate_changes_6_hours_ago(df, value_columns=None):
     """
-    Shift the values by 6 hours and calculate the difference between the current value
-    and the value 6 hours ago for each '_valeur' column
-    Replace NaNs (due to the shifting) with the original value so that difference = 0.
+    Shift the values by 6 hours and calculate, for each '_valeur' column, the difference and the percentage change
+    between the current value and the value 6 hours ago of the same site (assuming the rows are sorted by site and time).
+    The first 6 rows of a site have no value 6 hours ago: their difference is 0 and their percentage change is NaN.
     """
-    # Identify all '_valeur' columns, excluding those that end with '_type_de_valeur'
-    value_columns = [col for col in df.columns if col.endswith('_valeur') and not col.endswith('_type_de_valeur') or col == 'total_valeur_particule_g_par_L']
+    # Identify all '_valeur' columns, excluding those that end with '_type_de_valeur', unless given by the caller
+    if value_columns is None:
+        value_columns = [col for col in df.columns if col.endswith('_valeur') and not col.endswith('_type_de_valeur') or col == 'total_valeur_particule_g_par_L']
+    if not value_columns:
+        return df
     
+    # Ensure the columns are numeric, coerce errors to NaN
     for value_col in value_columns:
-        # Ensure the column is numeric, coerce errors to NaN
         df[value_col] = pd.to_numeric(df[value_col], errors='coerce')
-
-        # Shift the values by 6 hours using numpy roll
-        shifted_col = np.roll(df[value_col].values, 6)
-
-        # Replace the first 6 values (which are now shifted) with the original column values
-        shifted_col[:6] = df[value_col].iloc[:6].values
-
-        # Calculate the difference between the current value and the shifted value
-        diff_col = df[value_col].values - shifted_col
-        
-        # Add the new difference column to the dataframe
-        df[f"{value_col}_diff_6hrs"] = diff_col
     
-    return df
-
-
-def calculate_particle_variation(df):
-    """
-    Shift the values by 6 hours and calculate the percentage change between the current value and the value 6 hours ago for each '_valeur' column
-    """
-    # Identify all '_valeur' columns, excluding those that end with '_type_de_valeur'
-    value_columns = [col for col in df.columns if col.endswith('_valeur') and not col.endswith('_type_de_valeur') or col == 'total_valeur_particule_g_par_L']
+    # Both outputs are computed by the same Numba kernel in one pass over the values.
+    # The shift is done per site (rows are sorted by code_site and date_de_debut by merge_dataframes).
+    site_codes = pd.factorize(df['code_site'])[0]
+    diff, percent_change = diff_and_percent_change(df[value_columns].to_numpy(dtype=np.float64), site_codes, 6)
+    
+    # Add the new difference and percentage change columns to the dataframe
+    df[[f"{value_col}_diff_6hrs" for value_col in value_columns]] = diff
+    df[[f"{value_col}_percent_change_6hrs" for value_col in value_columns]] = percent_change
     
-    for value_col in value_columns:
-        # Ensure the column is numeric, coerce errors to NaN
-        df[value_col] = pd.to_numeric(df[value_col], errors='coerce')
-
-        # Shift the values by 6 hours (using numpy's shift equivalent)
-        shifted_col = np.roll(df[value_col].values, 6)
-
-        # Calculate the percentage change between the current value and the shifted value
-        percentage_change_col = ((df[value_col].values - shifted_col) / shifted_col) * 100
-
-        # Add the new difference and percentage change columns to the dataframe
-        df[f"{value_col}_percent_change_6hrs"] = percentage_change_col
-
     return df
 
 
@@ -150,39 +220,107 @@ def drop_unwanted_col_and_add_table_prefix(df, table_name):
       - Drop unwanted columns.
       - Rename columns by prefixing them with the table name (except for the grouping keys).
     """
-    # Drop unwanted columns if they exist.
-    df = df.drop(columns=[col for col in ['date_de_fin', 'polluant'] if col in df.columns], errors='ignore')
+    # Drop unwanted columns if they exist (in place, the DataFrame was just loaded for this table).
+    df.drop(columns=[col for col in ['date_de_fin', 'polluant'] if col in df.columns], inplace=True, errors='ignore')
     
-    # Rename columns by adding the table name as prefix.
-    rename_dict = {col: f"{table_name}_{col}" for col in df.columns if col not in ['code_site', 'date_de_debut']}
-    df = df.rename(columns=rename_dict)
+    # Rename columns by adding the table name as prefix (a new column Index, the data is not copied).
+    df.columns = [col if col in ['code_site', 'date_de_debut'] else f"{table_name}_{col}" for col in df.columns]
     
     return df
 
 
+def load_and_prefix_table(table, future):
+    """
+    Build the DataFrame of one table from its query future and add the table prefix to its columns.
+    Returns None if the table has no rows.
+    """
+    print(f"Processing table: {table}")
+    df = result_to_dataframe(future.result())
+    if df.empty:
+        print(f"Table '{table}' is empty. Skipping.")
+        return None
+    
+    # Preprocess by adding table prefix 
+    df_processed = drop_unwanted_col_and_add_table_prefix(df, table)
+    if df_processed.empty:
+        print(f"After processing, table '{table}' has no rows. Skipping.")
+        return None
+    return df_processed
+
+
 def merge_dataframes(dfs):
     """
     Merge a list of DataFrames on the common keys (code_site, date_de_debut) using an outer join.
+    All the DataFrames are aligned on their keys in a single concat instead of chaining pairwise merges.
     """
     if not dfs:
         return pd.DataFrame()
     
-    merged_df = dfs[0]
-    for df in dfs[1:]:
-        merged_df = pd.merge(merged_df, df, on=['code_site', 'date_de_debut'], how='outer')
+    indexed_dfs = []
+    for df in dfs:
+        df = df.set_index(['code_site', 'date_de_debut'])
+        # The keys are the Cassandra primary key so they should be unique, concat cannot align duplicated keys
+        indexed_dfs.append(df[~df.index.duplicated()])
+    
+    # Sort the keys like the outer merge did (the 6 hours shifts rely on rows being ordered by site and date)
+    merged_df = pd.concat(indexed_dfs, axis=1, join='outer').sort_index().reset_index()
     return merged_df
 
 
+def copy_rows_to_postgres(table, conn, keys, data_iter):
+    """
+    pandas to_sql insertion method: send the rows with a single COPY FROM STDIN instead of INSERT statements.
+    """
+    dbapi_conn = conn.connection
+    with dbapi_conn.cursor() as cur:
+        # Rows are serialized as CSV in memory (missing values become empty unquoted cells, read as NULL by COPY)
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerows(data_iter)
+        buf.seek(0)
+
+        columns = ', '.join(f'"{key}"' for key in keys)
+        table_name = f'"{table.schema}"."{table.name}"' if table.schema else f'"{table.name}"'
+        cur.copy_expert(f"COPY {table_name} ({columns}) FROM STDIN WITH (FORMAT CSV)", buf)
+
+
+@lru_cache(maxsize=4)
+def get_engine(host, port, database, user, password):
+    """
+    Create the SQLAlchemy engine of a PostgreSQL database once and reuse it (and its connection pool) on the next calls.
+    Connections are checked before use since the engine can outlive a database restart in a long-lived Airflow worker.
+    """
+    engine_str = f"postgresql+psycopg2://{user}:{password}@{host}:{port}/{database}"
+    return create_engine(engine_str, pool_size=4, pool_pre_ping=True)
+
+
 def ingest_dataframe_to_postgres(df, table_name, pg_config):
     """
     Ingest the given DataFrame into PostgreSQL.
+    The table is (re)created by pandas, the rows are loaded with COPY by chunks of copy_chunksize rows.
+    If COPY fails, the load is retried with multi-row INSERT statements of insert_chunksize rows.
     """
-    engine_str = (
-        f"postgresql+psycopg2://{pg_config['postgres_user']}:{pg_config['postgres_password']}"
-        f"@{pg_config['host']}:{pg_config['port']}/{pg_config['database']}"
-    )
-    engine = create_engine(engine_str)
-    df.to_sql(table_name, engine, if_exists='replace', index=False)
+    engine = get_engine(pg_config['host'], pg_config['port'], pg_config['database'], pg_config['postgres_user'], pg_config['postgres_password'])
+    try:
+        df.to_sql(
+            table_name,
+            engine,
+            if_exists='replace',
+            index=False,
+            method=copy_rows_to_postgres,
+            chunksize=pg_config.get('copy_chunksize', 100000)
+        )
+    except Exception as e:
+        # to_sql runs in a single transaction, the failed attempt left nothing behind
+        print(f"COPY into PostgreSQL table '{table_name}' failed ({e}), falling back to multi-row INSERT.")
+        df.to_sql(
+            table_name,
+            engine,
+            if_exists='replace',
+            index=False,
+            method='multi',
+            chunksize=pg_config.get('insert_chunksize', 10000)
+        )
     print(f"Data ingested into PostgreSQL table '{table_name}'.")
 
 
@@ -196,6 +334,9 @@ def main():
     # Connect to Cassandra.
     cluster = Cluster([config["cassandra"]["host"]], port=config["cassandra"]["port"])
     session = cluster.connect()
+    # Plain tuples are cheaper to build than named Row objects, tables are read by pages of FETCH_SIZE rows
+    session.row_factory = tuple_factory
+    session.default_fetch_size = FETCH_SIZE
     keyspace = config["cassandra"]["keyspace"]
     session.set_keyspace(keyspace)
     
@@ -203,26 +344,27 @@ def main():
     table_names = list_tables(session, keyspace)
     if not table_names:
         print("No tables found in Cassandra for keyspace:", keyspace)
+        cluster.shutdown()
         return
     
     processed_dfs = []
     processed_table_names = [] 
     
-    for table in table_names:
-        print(f"Processing table: {table}")
-        df = load_table_to_dataframe(session, table)
-        if df.empty:
-            print(f"Table '{table}' is empty. Skipping.")
-            continue
-        
-        # Preprocess by adding table prefix 
-        df_processed = drop_unwanted_col_and_add_table_prefix(df, table)
-        if df_processed.empty:
-            print(f"After processing, table '{table}' has no rows. Skipping.")
-            continue
-        
-        processed_dfs.append(df_processed)
-        processed_table_names.append(table)
+    # Send the queries of all the tables at once, their first pages are fetched while the previous tables are processed.
+    # The queries are prepared (table names cannot be bound, so one statement per table) so Cassandra parses them only once.
+    futures = {table: session.execute_async(session.prepare(f"SELECT * FROM {table}")) for table in table_names}
+    
+    # Tables are loaded and prefixed in threads: the page fetches of one table overlap the pandas work of the others
+    with ThreadPoolExecutor(max_workers=min(8, len(table_names))) as executor:
+        results = list(executor.map(load_and_prefix_table, futures.keys(), futures.values()))
+    
+    for table, df_processed in zip(futures.keys(), results):
+        if df_processed is not None:
+            processed_dfs.append(df_processed)
+            processed_table_names.append(table)
+    
+    # Everything needed from Cassandra is loaded (close its connections, the script may run inside a long-lived Airflow worker)
+    cluster.shutdown()
     
     if not processed_dfs:
         print("No data loaded from any table after processing.")
@@ -237,14 +379,15 @@ def main():
     # Now perform unit conversion.
     merged_df = convert_units(merged_df)
     
+    # Classify the value columns once for the next steps (the total column is added by the aggregation).
+    value_columns, valeur_columns, valeur_brute_columns = classify_columns(merged_df.columns)
+    value_columns.append("total_valeur_particule_g_par_L")
+    
     # Aggregate pollutant values.
-    merged_df = aggregate_valeurs(merged_df)
-
-    # Shift and calculate the difference between the current values and the values from 6 hours ago.
-    merged_df = shift_and_calculate_diff_6_hours_ago(merged_df)
+    merged_df = aggregate_valeurs(merged_df, valeur_columns, valeur_brute_columns)
 
-    # Calculate the percentage change in particle values between the current values and the values from 6 hours ago.
-    merged_df = calculate_particle_variation(merged_df)
+    # Shift and calculate the difference and the percentage change between the current values and the values from 6 hours ago.
+    merged_df = shift_and_calculate_changes_6_hours_ago(merged_df, value_columns)
     
     print("Curated DataFrame:")
     print(merged_df.head())
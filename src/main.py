@@ -1,12 +1,45 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
+from flask.json.provider import DefaultJSONProvider
+import orjson
 import pandas as pd
-import io
+import json
+import logging
 from unpacked_to_raw import upload_to_S3_with_csv
-import requests 
 import requests
-import base64
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """
+    JSON provider serializing the responses (jsonify) and parsing the request bodies with orjson (C) instead of the json module.
+    """
+    def dumps(self, obj, **kwargs):
+        # Types orjson does not know are left to Flask's default conversion
+        return orjson.dumps(obj, default=self.default, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
+# The upload helpers of unpacked_to_raw log their progress at INFO level, printed on the console like the rest of the API output
+logging.basicConfig(level=logging.INFO, format="%(message)s")
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+
+# Airflow webserver URL
+AIRFLOW_URL = 'http://localhost:8080'
+
+# HTTP session shared by the requests triggering DAGs: connections to Airflow are pooled and kept alive
+# instead of opening a new connection (and rebuilding the auth header) for every trigger
+airflow_session = requests.Session()
+airflow_session.auth = ('admin', 'admin')  # Authentication credentials
+airflow_session.headers['Content-Type'] = 'application/json'
+# Connection errors and transient webserver errors are retried with a short backoff.
+# POST is not idempotent: it is only retried on 502/503/504 or when the connection failed, never after a read error (the run may exist).
+airflow_retry = Retry(total=3, read=0, backoff_factor=0.3, status_forcelist=[502, 503, 504], allowed_methods=frozenset(['POST']))
+airflow_session.mount('http://', HTTPAdapter(pool_connections=32, pool_maxsize=64, max_retries=airflow_retry))
 
 
 @app.route('/ingest/csv', methods=['POST'])
@@ -16,19 +49,28 @@ def ingest_csv():
         return jsonify({'error': 'No files provided'}), 400
 
     csv_files = request.files.getlist('files')
-    results = {}
-
-    for file in csv_files:
-        if file.filename.endswith('.csv'):
-            try:
-                df = pd.read_csv(io.StringIO(file.stream.read().decode("utf-8")))
-                results[file.filename] = df.to_dict()  # Convert DataFrame to dictionary
-            except Exception as e:
-                results[file.filename] = {'error': str(e)}
-        else:
-            results[file.filename] = {'error': 'Invalid file format'}
 
-    return jsonify({'message': 'CSV files processed successfully', 'data': results}), 200
+    def file_to_json(file):
+        if not file.filename.endswith('.csv'):
+            return json.dumps({'error': 'Invalid file format'})
+        try:
+            # Parsed straight from the upload stream, and serialized to JSON records by pandas (in C) instead of Python dicts
+            df = pd.read_csv(file.stream)
+            return df.to_json(orient='records')
+        except Exception as e:
+            return json.dumps({'error': str(e)})
+
+    # The JSON texts are written as is (jsonify would have to decode and re-encode them), and handed to the
+    # response as a list of pieces instead of being joined into one more full copy of the body.
+    # Files are parsed here, the uploads are closed once the view returns.
+    pieces = ['{"message": "CSV files processed successfully", "data": {']
+    for i, file in enumerate(csv_files):
+        separator = ", " if i else ""
+        pieces.append(f"{separator}{json.dumps(file.filename)}: ")
+        pieces.append(file_to_json(file))
+    pieces.append('}}')
+
+    return Response(pieces, status=200, mimetype='application/json')
 
 
 @app.route('/ingest/blob', methods=['POST'])
@@ -57,32 +99,15 @@ def ingest():
     return jsonify(dag_response), 200
 
 def trigger_dag(dag_id, conf=None):
-    # Airflow webserver URL
-    airflow_url = 'http://localhost:8080'
-
-    # Authentication credentials
-    username = 'admin'
-    password = 'admin'
-
     # Endpoint for triggering DAGs
-    endpoint = f"{airflow_url}/api/v1/dags/{dag_id}/dagRuns"
-
-    # Create basic auth header
-    auth_credentials = f"{username}:{password}"
-    auth_bytes = auth_credentials.encode('ascii')
-    auth_base64 = base64.b64encode(auth_bytes).decode('ascii')
-
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Basic {auth_base64}"
-    }
+    endpoint = f"{AIRFLOW_URL}/api/v1/dags/{dag_id}/dagRuns"
 
     payload = {}
     if conf:
         payload["conf"] = conf
 
     try:
-        response = requests.post(endpoint, headers=headers, json=payload)
+        response = airflow_session.post(endpoint, json=payload, timeout=5)
 
         response.raise_for_status()
         return response.json()
@@ -1,15 +1,46 @@
 import os
 import re
 import csv
-import io
+import shutil
+import subprocess
 import yaml
 import unicodedata
 import time
-import datetime
+import tempfile
+from functools import lru_cache
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import boto3
+import pandas as pd
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from cassandra import ConsistencyLevel
 from cassandra.cluster import Cluster
+from cassandra.policies import DCAwareRoundRobinPolicy, TokenAwarePolicy
+from cassandra.query import BatchStatement, BatchType
 
+# C implementation of the YAML parser (libyaml) when PyYAML was built with it
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 
+
+# Compiled once instead of on every normalized column name
+NON_ALPHANUMERIC_RE = re.compile(r'[^a-z0-9]+')
+
+# Accented letters of the (French) headers mapped to their ASCII letter, UTF-8 BOM removed
+ACCENTED_LETTERS = 'àâäáãåçéèêëîïíìôöóòõûüúùÿýñ'
+ASCII_LETTERS = 'aaaaaaceeeeiiiiooooouuuuyyn'
+ACCENT_TABLE = str.maketrans(
+    ACCENTED_LETTERS + ACCENTED_LETTERS.upper(),
+    ASCII_LETTERS + ASCII_LETTERS.upper(),
+    '\ufeff'
+)
+
+
+# Headers share a small set of column names, so each one is normalized only once
+@lru_cache(maxsize=1024)
 def normalize_column_name(col):
     """
     Normalize column names to valid Cassandra identifiers:
@@ -18,12 +49,14 @@ def normalize_column_name(col):
       - Replace any non-alphanumeric characters with underscores
       - If a column starts with a digit, prefix it with an underscore
     """
-    # Remove accents and convert to ascii
-    col = unicodedata.normalize('NFKD', col).encode('ASCII', 'ignore').decode('utf-8')
+    # Remove accents with the translation table, unicodedata is only needed for other non-ascii characters
+    col = col.translate(ACCENT_TABLE)
+    if not col.isascii():
+        col = unicodedata.normalize('NFKD', col).encode('ASCII', 'ignore').decode('utf-8')
     col = col.lower().strip()
     
     # Replace non-alphanumeric characters with underscore
-    col = re.sub(r'[^a-z0-9]+', '_', col)
+    col = NON_ALPHANUMERIC_RE.sub('_', col)
     
     # If the first character is a digit, prefix with underscore
     if col and col[0].isdigit():
@@ -32,35 +65,52 @@ def normalize_column_name(col):
     return col
 
 
-def convert_value(col_name, value):
+# Typed columns of the CSV files, every other column is kept as text
+DATE_COLUMNS = ['date_de_debut', 'date_de_fin']
+FLOAT_COLUMNS = ['valeur', 'valeur_brute', 'taux_de_saisie']
+
+
+def convert_chunk(chunk):
     """
-    Convert CSV string values to the appropriate Python types based on the column.
+    Convert the text values of a DataFrame chunk to the appropriate Python types, whole columns at a time:
+      - Drop the rows where every cell is empty
+      - Parse the date columns to datetimes and the numeric columns to floats (invalid values become None)
+      - Replace empty strings and missing values by None
     """
-    if value == "" or value is None:
-        return None
+    # Rows where every cell is empty (or only whitespace) are dropped after the conversions
+    # (converting the chunk read by pandas in place avoids copying a filtered slice first)
+    non_empty = chunk.apply(lambda col: col.str.strip() != '').any(axis=1)
+    
+    for col in DATE_COLUMNS:
+        if col in chunk.columns:
+            # Dates come with or without a time component: only the values the long format did not parse
+            # are parsed again with the short one (cache=True parses each distinct date string once)
+            dates = pd.to_datetime(chunk[col], format="%Y/%m/%d %H:%M:%S", errors='coerce', cache=True)
+            missing = dates.isna() & (chunk[col] != '')
+            if missing.any():
+                dates[missing] = pd.to_datetime(chunk.loc[missing, col], format="%Y/%m/%d", errors='coerce', cache=True)
+            chunk[col] = dates
+    for col in FLOAT_COLUMNS:
+        if col in chunk.columns:
+            chunk[col] = pd.to_numeric(chunk[col], errors='coerce')
+    
+    # Python objects for the Cassandra driver (None instead of '', NaN and NaT)
+    chunk = chunk[non_empty].astype(object)
+    return chunk.where(chunk.notna() & (chunk != ''), None)
 
-    # Convert date columns to datetime objects.
-    if col_name in ('date_de_debut', 'date_de_fin'):
-        # Try parsing with a datetime format. Adjust the format if needed.
-        try:
-            # If a time component is present:
-            if " " in value:
-                return datetime.datetime.strptime(value, "%Y/%m/%d %H:%M:%S")
-            else:
-                return datetime.datetime.strptime(value, "%Y/%m/%d")
-        except Exception as e:
-            print(f"Error parsing date for column {col_name} with value '{value}': {e}")
-            return None
-
-    # Convert numeric fields to float
-    elif col_name in ('valeur', 'valeur_brute', 'taux_de_saisie'):
-        try:
-            return float(value)
-        except Exception as e:
-            print(f"Error converting float for column {col_name} with value '{value}': {e}")
-            return None
 
-    return value
+# Maximum number of insert requests waiting for their response
+MAX_IN_FLIGHT = 512
+
+# Files larger than this are downloaded with concurrent ranged GET requests to a temporary file
+MULTIPART_THRESHOLD = 8 * 1024 * 1024
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=MULTIPART_THRESHOLD, max_concurrency=10)
+
+# Manifest of the S3 files already loaded (shared with the faster script, both load the same staging tables)
+PROCESSED_FILES_TABLE = "processed_files"
+
+# Rows per same-partition batch (kept well under Cassandra's default 50 KB batch size failure threshold)
+BATCH_SIZE = 50
 
 
 def create_cassandra_keyspace(session, keyspace):
@@ -110,45 +160,197 @@ def create_cassandra_table(session, table_name):
     session.execute(create_table_query)
 
 
+def create_processed_files_table(session):
+    """
+    Create the manifest table recording the S3 files already loaded in staging, with their ETag.
+    """
+    session.execute(f"""
+        CREATE TABLE IF NOT EXISTS {PROCESSED_FILES_TABLE} (
+            key text PRIMARY KEY,
+            etag text,
+            processed_at timestamp
+        );
+    """)
+
+
+def load_processed_files(session):
+    """
+    Load the manifest of processed files as a {key: etag} dictionary.
+    """
+    rows = session.execute(f"SELECT key, etag FROM {PROCESSED_FILES_TABLE}")
+    return {row.key: row.etag for row in rows}
+
+
+def record_processed_files(session, files):
+    """
+    Record the given S3 files (with their current ETag) in the manifest of processed files.
+    """
+    prepared = session.prepare(
+        f"INSERT INTO {PROCESSED_FILES_TABLE} (key, etag, processed_at) VALUES (?, ?, toTimestamp(now()))"
+    )
+    pending = deque()
+    for obj in files:
+        pending.append(session.execute_async(prepared, (obj["Key"], obj.get("ETag"))))
+    while pending:
+        pending.popleft().result()
+
+
 def get_s3_files(s3, bucket_name, prefix):
     """
-    Get list of files from S3 with the given prefix/key/particle_code.
+    Yield the files from S3 with the given prefix/key/particle_code, page by page.
+    The paginator follows the continuation tokens, list_objects_v2 alone returns at most 1000 keys.
+    """
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        yield from page.get("Contents", [])
+
+
+def read_csv_chunks(source, chunksize, **kwargs):
+    """
+    Parse a CSV source with the pandas C parser as DataFrame chunks of text values (empty cells stay empty strings).
     """
-    response = s3.list_objects_v2(Bucket=bucket_name, Prefix=prefix)
-    if "Contents" not in response:
-        return []
-    return response["Contents"]
+    try:
+        yield from pd.read_csv(source, sep=';', chunksize=chunksize, dtype=str, na_filter=False, **kwargs)
+    except pd.errors.EmptyDataError:
+        # Empty file (not even a header)
+        return
 
 
-def process_s3_file(s3, bucket_name, key):
+def iter_s3_chunks(s3, bucket_name, key, size=0, chunksize=100_000):
     """
-    Read and parse a CSV file from S3 bucket.
+    Stream a CSV file from S3 bucket as DataFrame chunks of text values.
+    Large files are downloaded with the transfer manager (concurrent ranged GETs) to a temporary file, which is
+    memory mapped for parsing: the file is never held in memory as a whole, the OS page cache serves the parser.
     """
+    if size > MULTIPART_THRESHOLD:
+        with tempfile.NamedTemporaryFile(suffix=".csv") as tmp:
+            s3.download_fileobj(bucket_name, key, tmp, Config=TRANSFER_CONFIG)
+            tmp.flush()
+            yield from read_csv_chunks(tmp.name, chunksize, memory_map=True)
+        return
+    
     obj_response = s3.get_object(Bucket=bucket_name, Key=key)
-    content = obj_response["Body"].read().decode("utf-8")
-    reader = csv.reader(io.StringIO(content), delimiter=';')
-    return list(reader)
+    # pandas does not close a handle it was given: the body is closed here, its connection goes back to the pool
+    # as soon as the file is parsed instead of when the garbage collector frees it
+    with obj_response["Body"] as body:
+        yield from read_csv_chunks(body, chunksize)
+
+
+def process_s3_file(s3, bucket_name, key, size=0):
+    """
+    Read and parse a CSV file from S3 bucket with the pandas C parser, chunk by chunk.
+    Returns the normalized header, a DataFrame of the non-empty converted data rows and the 64-bit hash of each row,
+    or (None, None, None) for an empty file.
+    """
+    header = None
+    chunks = []
+    for chunk in iter_s3_chunks(s3, bucket_name, key, size):
+        if header is None:
+            header = [normalize_column_name(col) for col in chunk.columns]
+        chunk.columns = header
+        chunks.append(convert_chunk(chunk))
+    if header is None:
+        return None, None, None
+    df = pd.concat(chunks, ignore_index=True)
+    # Rows are hashed here, in the download thread, so that the deduplication across files only compares integers
+    return header, df, pd.util.hash_pandas_object(df, index=False)
 
 
 def insert_data_into_cassandra(session, table_name, columns, data):
     """
-    Insert data rows into the Cassandra table after converting values.
+    Insert converted data rows into the Cassandra table.
+    Rows are grouped by partition key (code_site) into UNLOGGED batches, each applied by a single replica.
     """
     # Prepare the insert query
     insert_columns = ", ".join(columns)
     placeholders = ", ".join(["?"] * len(columns)) # Prepare placeholders for the prepared statement : (?, ?, ?, ...)
-    insert_query = f"INSERT INTO {table_name} ({insert_columns}) VALUES ({placeholders}) IF NOT EXISTS"
+    # No IF NOT EXISTS: it would make every insert a lightweight transaction (Paxos round-trips serialized on the partition).
+    # Rows are already deduplicated by process_pollutant (on their 64-bit row hashes), and a plain INSERT is idempotent on (code_site, date_de_debut).
+    insert_query = f"INSERT INTO {table_name} ({insert_columns}) VALUES ({placeholders})"
+    # Each table has its own columns, so the statement is prepared once per table and shared by all its batches
     prepared = session.prepare(insert_query)
     
+    # Group the rows (already converted) by partition key
+    code_site_index = columns.index("code_site")
+    rows_by_site = defaultdict(list)
     for row in data:
-        # Convert each value in the row using the column name
-        converted_row = [convert_value(col, value) for col, value in zip(columns, row)]
-        session.execute(prepared, converted_row)
+        rows_by_site[row[code_site_index]].append(row)
+    
+    # Send the batches asynchronously, with a sliding window of at most MAX_IN_FLIGHT pending requests
+    pending = deque()
+    for site_rows in rows_by_site.values():
+        for start in range(0, len(site_rows), BATCH_SIZE):
+            batch = BatchStatement(batch_type=BatchType.UNLOGGED, consistency_level=ConsistencyLevel.ONE)
+            for converted_row in site_rows[start:start + BATCH_SIZE]:
+                batch.add(prepared, converted_row)
+            pending.append(session.execute_async(batch))
+            if len(pending) >= MAX_IN_FLIGHT:
+                # Wait for the oldest request before sending more
+                pending.popleft().result()
+    
+    # Wait for the remaining requests
+    while pending:
+        pending.popleft().result()
 
 
-def process_pollutant(pollutant, s3, session, bucket_name):
+def format_copy_value(value):
+    """
+    Format a value for the CSV file loaded by cqlsh COPY.
+    """
+    # Missing values are written as empty cells, which COPY loads as null
+    if value is None:
+        return ''
+    # Dates are written with isoformat (same text as the DATETIMEFORMAT of the COPY) rather than strftime's format parsing
+    if hasattr(value, "isoformat"):
+        return value.isoformat(sep=' ', timespec='seconds')
+    return value
+
+
+def copy_into_cassandra(cassandra_config, table_name, columns, data):
+    """
+    Bulk load data rows into the Cassandra table with cqlsh COPY FROM.
+    COPY splits the file between several worker processes that send large unlogged batches,
+    which loads a full table faster than driver-side inserts.
+    Returns True if the load succeeded, False otherwise (the caller falls back to driver inserts).
+    """
+    with tempfile.NamedTemporaryFile("w", suffix=".csv", newline="", encoding="utf-8") as tmp:
+        writer = csv.writer(tmp, delimiter=';')
+        writer.writerow(columns)
+        for row in data:
+            writer.writerow([format_copy_value(value) for value in row])
+        tmp.flush()
+        
+        copy_query = (
+            f"COPY {cassandra_config['keyspace']}.{table_name} ({', '.join(columns)}) FROM '{tmp.name}' "
+            f"WITH HEADER = TRUE AND DELIMITER = ';' AND DATETIMEFORMAT = '%Y-%m-%d %H:%M:%S' AND NUMPROCESSES = 8"
+        )
+        # A hung cqlsh (node not answering, stuck COPY worker) is killed after a timeout sized on the number of rows:
+        # copy_timeout seconds plus 1 ms per row, i.e. COPY must load at least 1000 rows per second
+        timeout = cassandra_config.get("copy_timeout", 60) + len(data) / 1000
+        try:
+            result = subprocess.run(
+                ["cqlsh", str(cassandra_config["host"]), str(cassandra_config["port"]), "-e", copy_query],
+                capture_output=True,
+                text=True,
+                timeout=timeout
+            )
+        except subprocess.TimeoutExpired:
+            print(f"cqlsh COPY into {table_name} timed out after {timeout:.0f} seconds.")
+            return False
+        except OSError as e:
+            print(f"cqlsh COPY into {table_name} could not be run: {e}")
+            return False
+    if result.returncode != 0:
+        print(f"cqlsh COPY into {table_name} failed: {result.stderr.strip()}")
+        return False
+    return True
+
+
+def process_pollutant(pollutant, s3, session, bucket_name, processed_files, bulk_load_config=None):
     """
     Process a single pollutant's data files.
+    Files already loaded whose ETag did not change since (see processed_files) are skipped.
+    With bulk_load_config (the Cassandra configuration), the rows are loaded with cqlsh COPY instead of driver inserts.
     """
     pollutant_code = pollutant["code"]
     pollutant_short_name = pollutant["short_name"]
@@ -158,57 +360,94 @@ def process_pollutant(pollutant, s3, session, bucket_name):
     
     # List all objects in S3 for the given pollutant folder/key
     prefix = f"{pollutant_code}/"
-    files = get_s3_files(s3, bucket_name, prefix)
+    # Only download the new or changed files (filtered while the listing pages are streamed)
+    files = [obj for obj in get_s3_files(s3, bucket_name, prefix) if processed_files.get(obj["Key"]) != obj.get("ETag")]
     
     if not files:
-        print(f"No files found in S3 for pollutant {pollutant_short_name}.")
+        print(f"No new or changed files found in S3 for pollutant {pollutant_short_name}.")
         return
     
-    # Process all files and collect data
-    all_rows = []
+    # Process all files and collect their data
+    frames = []
+    hashes = []
     header_normalized = None
-
-    seen = set() # Rows already seen (to avoid duplicates)
     
-    for obj in files:
+    read_files = [] # Files whose rows were kept, recorded in the manifest once inserted
+    
+    # Download and parse the files in parallel (the boto3 client is thread safe), in the order of the listing
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        files_data = list(executor.map(lambda obj: process_s3_file(s3, bucket_name, obj["Key"], obj.get("Size", 0)), files))
+    
+    # Header validation stays in this thread, in file order
+    for obj, (normalized_header, df, row_hashes) in zip(files, files_data):
         key = obj["Key"]
         print(f"Processing file: {key}")
-        rows = process_s3_file(s3, bucket_name, key)
         
-        if not rows:
+        if normalized_header is None:
             continue
         
-        # Normalize header names
-        header = rows[0]
-        normalized_header = [normalize_column_name(col) for col in header]
-        
-        # Initialize header if first file or validate header if not
+        # Initialize header if first file or validate header if not (names are normalized by process_s3_file)
         if header_normalized is None:
             header_normalized = normalized_header
-            all_rows.append(header_normalized)
         elif normalized_header != header_normalized: # Should match the first file's header but just in case
             print(f"Header mismatch in file {key}. Skipping file.")
             continue
-        
-        # Add non-empty data rows and skip duplicates
-        for row in rows[1:]:
-            if row and any(cell.strip() for cell in row) and tuple(row) not in seen:
-                seen.add(tuple(row))
-                all_rows.append(row)
+        read_files.append(obj)
+        frames.append(df)
+        hashes.append(row_hashes)
+    
+    # Drop duplicate rows across all the files at once, on the 64-bit row hashes instead of comparing every column
+    # (empty rows are already dropped by process_s3_file)
+    all_rows = []
+    if frames:
+        data = pd.concat(frames, ignore_index=True)
+        duplicated = pd.concat(hashes, ignore_index=True).duplicated().to_numpy()
+        all_rows = list(data[~duplicated].itertuples(index=False, name=None))
     
     # Check if we have any data
-    if len(all_rows) <= 1:
+    if not all_rows:
         print(f"No data rows found for pollutant {pollutant_short_name}.")
+        record_processed_files(session, read_files)
         return
     
-    print(f"Total rows for {pollutant_short_name}: {len(all_rows)-1}")
+    print(f"Total rows for {pollutant_short_name}: {len(all_rows)}")
     
     # Create Cassandra table and insert data
     create_cassandra_table(session, table_name)
     print(f"Created table {table_name}.")
     
-    insert_data_into_cassandra(session, table_name, header_normalized, all_rows[1:])
+    if not (bulk_load_config and copy_into_cassandra(bulk_load_config, table_name, header_normalized, all_rows)):
+        insert_data_into_cassandra(session, table_name, header_normalized, all_rows)
     print(f"Insertion into table '{table_name}' done.")
+    
+    # Reached only if every insert succeeded (a failed batch raises), the files are not read again on the next run
+    record_processed_files(session, read_files)
+
+
+def connect_s3(config, max_pool_connections=32):
+    """
+    Create the S3 client from the configuration.
+    """
+    return boto3.client(
+        "s3",
+        endpoint_url=config["s3"]["endpoint_url"],
+        aws_access_key_id=config["s3"]["aws_access_key_id"],
+        aws_secret_access_key=config["s3"]["aws_secret_access_key"],
+        config=Config(max_pool_connections=max_pool_connections) # Enough connections for the download threads
+    )
+
+
+def connect_cassandra(config):
+    """
+    Create the Cassandra cluster from the configuration.
+    Token aware routing sends each batch straight to a replica of its partition.
+    """
+    return Cluster(
+        [config["cassandra"]["host"]],
+        port=config["cassandra"]["port"],
+        load_balancing_policy=TokenAwarePolicy(DCAwareRoundRobinPolicy()),
+        protocol_version=4
+    )
 
 
 def main():
@@ -217,37 +456,55 @@ def main():
 
     # Load config variables from config/config.yaml
     with open("config/config.yaml", "r") as f:
-        config = yaml.safe_load(f)
+        config = yaml.load(f, Loader=SafeLoader)
     with open("config/pollutants.yaml", "r") as f:
-        pollutants = yaml.safe_load(f)
-
-    # Get AWS credentials from config
-    aws_access_key_id = config["s3"]["aws_access_key_id"]
-    aws_secret_access_key = config["s3"]["aws_secret_access_key"]
+        pollutants = yaml.load(f, Loader=SafeLoader)
 
-    # Connect to s3
-    s3 = boto3.client(
-        "s3",
-        endpoint_url=config["s3"]["endpoint_url"],
-        aws_access_key_id=aws_access_key_id,
-        aws_secret_access_key=aws_secret_access_key
-    )
+    # Process the pollutants in parallel threads. The script runs inside the Airflow task process, which cannot start
+    # child processes under the Celery prefork pool, and the prints of the threads stay in the task log.
+    # The S3 client and the Cassandra session are thread safe, they are shared by all the pollutants.
+    max_workers = min(len(pollutants), os.cpu_count() or 1)
+    s3 = connect_s3(config, max_pool_connections=16 * max_workers) # 16 download threads per pollutant
     bucket_name = config["s3"]["bucket_name"]
-
+    
     # Connect to Cassandra
-    cluster = Cluster([config["cassandra"]["host"]], port=config["cassandra"]["port"])
-    session = cluster.connect()
-    keyspace = config["cassandra"]["keyspace"]
-    # Create keyspace if it does not exist
-    create_cassandra_keyspace(session, keyspace)
-
-    # Process each pollutant
-    for pollutant in pollutants:
-        print("pollutant: ", pollutant)
-        process_pollutant(pollutant, s3, session, bucket_name)
+    cluster = connect_cassandra(config)
+    failed_pollutants = []
+    try:
+        session = cluster.connect()
+        session.default_timeout = 30
+        keyspace = config["cassandra"]["keyspace"]
+        # Create keyspace if it does not exist
+        create_cassandra_keyspace(session, keyspace)
+        
+        # Load the manifest of the files processed by previous runs
+        create_processed_files_table(session)
+        processed_files = load_processed_files(session)
+        
+        # The bulk load is opt-in (config.yaml) and needs cqlsh, which the Airflow image does not ship by default
+        bulk_load_config = config["cassandra"] if config["cassandra"].get("bulk_load") and shutil.which("cqlsh") else None
+        
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(process_pollutant, pollutant, s3, session, bucket_name, processed_files, bulk_load_config): pollutant
+                for pollutant in pollutants
+            }
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"Error in pollutant processing ({futures[future]['short_name']}): {e}")
+                    failed_pollutants.append(futures[future]["short_name"])
+    finally:
+        # Close the Cassandra connections (the script runs inside a long-lived Airflow worker)
+        cluster.shutdown()
     
     elapsed_time = time.time() - start_time
     print(f"Total time taken: {elapsed_time // 60} minutes and {elapsed_time % 60} seconds.")
+    
+    # The other pollutants are processed anyway, then the task fails so that Airflow retries it
+    if failed_pollutants:
+        raise RuntimeError(f"Processing failed for pollutants: {', '.join(failed_pollutants)}")
 
 if __name__ == "__main__":
     main()
@@ -1,29 +1,52 @@
 import os
+import csv
+import io
 import yaml
 import pandas as pd
+import numpy as np
 import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from cassandra.cluster import Cluster
+from cassandra.query import tuple_factory
 from sqlalchemy import create_engine
 
 
+# Manifest of the files loaded by the staging step, not a pollutant table
+PROCESSED_FILES_TABLE = "processed_files"
+# Rows fetched per page when loading a table
+FETCH_SIZE = 5000
+
+
 def list_tables(session, keyspace):
     """
-    List all tables in the given keyspace.
+    List all pollutant tables in the given keyspace.
     """
-    query = f"SELECT table_name FROM system_schema.tables WHERE keyspace_name = '{keyspace}'"
-    rows = session.execute(query)
-    table_names = [row.table_name for row in rows]
+    # The keyspace is bound as a parameter of a prepared statement rather than formatted into the query
+    query = session.prepare("SELECT table_name FROM system_schema.tables WHERE keyspace_name = ?")
+    rows = session.execute(query, (keyspace,))
+    # The session returns plain tuples (tuple_factory), table_name is the only selected column
+    table_names = [row[0] for row in rows if row[0] != PROCESSED_FILES_TABLE]
     return table_names
 
 
-def load_table_to_dataframe(session, table_name):
+def result_to_dataframe(rows):
     """
-    Load all rows from a Cassandra table into a pandas DataFrame.
+    Build a pandas DataFrame from a Cassandra result set, fetching its remaining pages.
+    Rows are read page by page as plain tuples (session.row_factory = tuple_factory) and
+    appended to one list per column, so the full table is never held as a list of Row objects.
     """
-    query = f"SELECT * FROM {table_name}"
-    rows = session.execute(query)
-    # DataFrame from list of rows.
-    df = pd.DataFrame(list(rows))
+    columns = {name: [] for name in rows.column_names}
+    column_lists = list(columns.values())
+    while True:
+        page = rows.current_rows
+        if page:
+            for column_list, values in zip(column_lists, zip(*page)):
+                column_list.extend(values)
+        if not rows.has_more_pages:
+            break
+        rows.fetch_next_page()
+    df = pd.DataFrame(columns)
     return df
 
 
@@ -38,6 +61,8 @@ def convert_units(df):
         "ng-m3": 1e-9,  # Nanograms per cubic meter to g/L
     }
     
+    factors = np.append(np.array(list(unit_conversion.values())), np.nan)
+    
     # Detect unit columns dynamically
     unit_columns = [col for col in df.columns if col.endswith("_unite_de_mesure")]
     
@@ -53,45 +78,51 @@ def convert_units(df):
             # Backward-fill missing values in unit column
             df.loc[:, unit_column] = df[unit_column].bfill()
         
-        # Create a conversion factor column
-        df[f"{table_prefix}_conversion_factor"] = df[unit_column].map(unit_conversion)
+        # Conversion factor of each row: the category codes index the factors array
+        # (unknown units get the code -1, which picks the NaN appended at the end)
+        units = pd.Categorical(df[unit_column], categories=list(unit_conversion))
+        conversion_factors = factors[units.codes]
         
         # Convert value columns
         for value_suffix in ["_valeur", "_valeur_brute"]:
             value_col = f"{table_prefix}{value_suffix}"
             if value_col in df.columns:
-                df[f"{value_col}_g_par_L"] = df[value_col] * df[f"{table_prefix}_conversion_factor"]
-        
-        # Remove the temporary conversion factor column
-        df.drop(columns=[f"{table_prefix}_conversion_factor"], inplace=True)
+                df[f"{value_col}_g_par_L"] = df[value_col].to_numpy() * conversion_factors
     
     return df
 
 
-def aggregate_valeurs(df):
+def classify_columns(columns):
+    """
+    Sort the column names of the merged DataFrame in a single pass.
+    Returns the '_valeur' columns (excluding those ending with '_type_de_valeur'),
+    the '_valeur_g_par_L' columns and the '_valeur_brute_g_par_L' columns.
+    """
+    value_columns, valeur_columns, valeur_brute_columns = [], [], []
+    for col in columns:
+        if col.endswith("_valeur_g_par_L"):
+            valeur_columns.append(col)
+        elif col.endswith("_valeur_brute_g_par_L"):
+            valeur_brute_columns.append(col)
+        elif col.endswith("_valeur") and not col.endswith("_type_de_valeur"):
+            value_columns.append(col)
+    return value_columns, valeur_columns, valeur_brute_columns
+
+
+def aggregate_valeurs(df, valeur_columns=None, valeur_brute_columns=None):
     """
     Aggregate all columns ending with '_valeur_g_par_L' (excluding those ending with '_type_de_valeur')
-    and columns ending with '_valeur_brute_g_par_L' into a new column 'total_valeur_particule_g_par_L' using NumPy.
+    and columns ending with '_valeur_brute_g_par_L' into a new column 'total_valeur_particule_g_par_L' using pandas.
     """
-    valeur_columns = [col for col in df.columns if col.endswith("_valeur_g_par_L") and not col.endswith("_type_de_valeur")]
-    valeur_brute_columns = [col for col in df.columns if col.endswith("_valeur_brute_g_par_L")]
+    if valeur_columns is None or valeur_brute_columns is None:
+        _, valeur_columns, valeur_brute_columns = classify_columns(df.columns)
     cols = valeur_columns + valeur_brute_columns
 
-    # Using pandas sum method
-    # df["total_valeur_particule"] = df[cols].sum(axis=1, skipna=True)
-
-    # Iterate over each row in the DataFrame and compute the sum of the specified columns
-    total_valeur_particule = []
-    for idx in df.index:
-        row_sum = 0  # Initialize the sum for the current row
-        for col in cols:
-            value = df.at[idx, col]  # Access the value at the given row and column
-            if pd.notnull(value):    # Only add if the value is not NaN
-                row_sum += value
-        total_valeur_particule.append(row_sum)
-
-    # Assign the computed sums as a new column in the DataFrame
-    df["total_valeur_particule_g_par_L"] = total_valeur_particule
+    # Cast the columns to a numeric dtype once so the sum runs on float64 blocks (not object values)
+    df[cols] = df[cols].apply(pd.to_numeric, errors="coerce")
+
+    # Row-wise sum in pandas' C reducer (missing values are skipped, a row with none sums to 0)
+    df["total_valeur_particule_g_par_L"] = df[cols].sum(axis=1, skipna=True)
     return df
 
 
@@ -99,34 +130,49 @@ def replace_null_values_by_mean(df):
     """
     Replace null numeric values with the mean of their respective column.
     """
-    numeric_cols = df.select_dtypes(include='number').columns
-    for col in numeric_cols:
-        mean_val = df[col].mean()
-        df[col] = df[col].fillna(mean_val)
+    numeric_df = df.select_dtypes(include='number')
+    # fillna with the Series of column means fills every numeric column in one call
+    df[numeric_df.columns] = numeric_df.fillna(numeric_df.mean())
     return df
 
 
-def shift_and_calculate_diff_6_hours_ago(df):
+def same_site_mask(df, periods=6):
+    """
+    For each row from the `periods`-th on, tell whether the row `periods` rows before belongs to the same site.
+    The DataFrame must be sorted by (code_site, date_de_debut), as returned by merge_dataframes.
+    """
+    site_codes = pd.factorize(df['code_site'])[0]
+    return site_codes[periods:] == site_codes[:-periods]
+
+
+def shift_and_calculate_diff_6_hours_ago(df, value_columns=None):
     """
     Shift the values by 6 hours and calculate the difference between the current value
-    and the value 6 hours ago for each '_valeur' column
+    and the value 6 hours ago of the same site for each '_valeur' column
     Replace NaNs (due to the shifting) with the original value so that difference = 0.
     """
-    # Identify all '_valeur' columns, excluding those that end with '_type_de_valeur'
-    value_columns = [col for col in df.columns if col.endswith('_valeur') and not col.endswith('_type_de_valeur') or col == 'total_valeur_particule_g_par_L']
+    # Identify all '_valeur' columns, excluding those that end with '_type_de_valeur', unless given by the caller
+    if value_columns is None:
+        value_columns = [col for col in df.columns if col.endswith('_valeur') and not col.endswith('_type_de_valeur') or col == 'total_valeur_particule_g_par_L']
+    
+    # The shift is done per site: the first 6 rows of a site have no value 6 hours ago
+    same_site = same_site_mask(df)
     
     for value_col in value_columns:
         # Ensure the column is numeric, coerce errors to NaN
         df[value_col] = pd.to_numeric(df[value_col], errors='coerce')
 
-        # Shift the values by 6 hours (assuming the date_de_debut column is sorted by time)
-        shifted_col = df[value_col].shift(6)
+        values = df[value_col].to_numpy(dtype=np.float64)
 
-        # Replace NaNs in the shifted column with corresponding values from the original column
-        shifted_col.fillna(df[value_col], inplace=True)
+        # Difference with the value 6 rows before (assuming the date_de_debut column is sorted by time),
+        # computed on NumPy slices instead of a shifted Series
+        diff_col = np.empty_like(values)
+        np.subtract(values[6:], values[:-6], out=diff_col[6:])
 
-        # Calculate the difference between the current value and the shifted value
-        diff_col = df[value_col] - shifted_col
+        # Without a value 6 hours ago, the value is compared to itself so that difference = 0
+        diff_col[:6] = values[:6] - values[:6]
+        missing = np.isnan(values[:-6]) | ~same_site
+        diff_col[6:][missing] = values[6:][missing] - values[6:][missing]
         
         # Add the new difference column to the dataframe
         df[f"{value_col}_diff_6hrs"] = diff_col
@@ -134,22 +180,33 @@ def shift_and_calculate_diff_6_hours_ago(df):
     return df
 
 
-def calculate_particle_variation(df):
+def calculate_particle_variation(df, value_columns=None):
     """
-    Shift the values by 6 hours and calculate the percentage change between the current value and the value 6 hours ago for each '_valeur' column
+    Shift the values by 6 hours and calculate the percentage change between the current value and the value 6 hours ago
+    of the same site for each '_valeur' column
     """
-    # Identify all '_valeur' columns, excluding those that end with '_type_de_valeur'
-    value_columns = [col for col in df.columns if col.endswith('_valeur') and not col.endswith('_type_de_valeur') or col == 'total_valeur_particule_g_par_L']
+    # Identify all '_valeur' columns, excluding those that end with '_type_de_valeur', unless given by the caller
+    if value_columns is None:
+        value_columns = [col for col in df.columns if col.endswith('_valeur') and not col.endswith('_type_de_valeur') or col == 'total_valeur_particule_g_par_L']
+    
+    # The shift is done per site: the first 6 rows of a site have no value 6 hours ago
+    same_site = same_site_mask(df)
     
     for value_col in value_columns:
         # Ensure the column is numeric, coerce errors to NaN
         df[value_col] = pd.to_numeric(df[value_col], errors='coerce')
 
-        # Shift the values by 6 hours (assuming the date_de_debut column is sorted by time)
-        shifted_col = df[value_col].shift(6)
+        values = df[value_col].to_numpy(dtype=np.float64)
 
-        # Calculate the percentage change between the current value and the shifted value
-        percentage_change_col = ((df[value_col] - shifted_col) / shifted_col) * 100
+        # Percentage change with the value 6 rows before (assuming the date_de_debut column is sorted by time),
+        # computed on NumPy slices instead of a shifted Series (no value 6 hours ago gives NaN)
+        percentage_change_col = np.empty_like(values)
+        percentage_change_col[:6] = np.nan
+        with np.errstate(divide='ignore', invalid='ignore'):
+            np.subtract(values[6:], values[:-6], out=percentage_change_col[6:])
+            np.divide(percentage_change_col[6:], values[:-6], out=percentage_change_col[6:])
+        percentage_change_col[6:] *= 100
+        percentage_change_col[6:][~same_site] = np.nan
 
         # Add the new difference and percentage change columns to the dataframe
         df[f"{value_col}_percent_change_6hrs"] = percentage_change_col
@@ -163,39 +220,107 @@ def drop_unwanted_col_and_add_table_prefix(df, table_name):
       - Drop unwanted columns.
       - Rename columns by prefixing them with the table name (except for the grouping keys).
     """
-    # Drop unwanted columns if they exist.
-    df = df.drop(columns=[col for col in ['date_de_fin', 'polluant'] if col in df.columns], errors='ignore')
+    # Drop unwanted columns if they exist (in place, the DataFrame was just loaded for this table).
+    df.drop(columns=[col for col in ['date_de_fin', 'polluant'] if col in df.columns], inplace=True, errors='ignore')
     
-    # Rename columns by adding the table name as prefix.
-    rename_dict = {col: f"{table_name}_{col}" for col in df.columns if col not in ['code_site', 'date_de_debut']}
-    df = df.rename(columns=rename_dict)
+    # Rename columns by adding the table name as prefix (a new column Index, the data is not copied).
+    df.columns = [col if col in ['code_site', 'date_de_debut'] else f"{table_name}_{col}" for col in df.columns]
     
     return df
 
 
+def load_and_prefix_table(table, future):
+    """
+    Build the DataFrame of one table from its query future and add the table prefix to its columns.
+    Returns None if the table has no rows.
+    """
+    print(f"Processing table: {table}")
+    df = result_to_dataframe(future.result())
+    if df.empty:
+        print(f"Table '{table}' is empty. Skipping.")
+        return None
+    
+    # Preprocess by adding table prefix 
+    df_processed = drop_unwanted_col_and_add_table_prefix(df, table)
+    if df_processed.empty:
+        print(f"After processing, table '{table}' has no rows. Skipping.")
+        return None
+    return df_processed
+
+
 def merge_dataframes(dfs):
     """
     Merge a list of DataFrames on the common keys (code_site, date_de_debut) using an outer join.
+    All the DataFrames are aligned on their keys in a single concat instead of chaining pairwise merges.
     """
     if not dfs:
         return pd.DataFrame()
     
-    merged_df = dfs[0]
-    for df in dfs[1:]:
-        merged_df = pd.merge(merged_df, df, on=['code_site', 'date_de_debut'], how='outer')
+    indexed_dfs = []
+    for df in dfs:
+        df = df.set_index(['code_site', 'date_de_debut'])
+        # The keys are the Cassandra primary key so they should be unique, concat cannot align duplicated keys
+        indexed_dfs.append(df[~df.index.duplicated()])
+    
+    # Sort the keys like the outer merge did (the 6 hours shifts rely on rows being ordered by site and date)
+    merged_df = pd.concat(indexed_dfs, axis=1, join='outer').sort_index().reset_index()
     return merged_df
 
 
+def copy_rows_to_postgres(table, conn, keys, data_iter):
+    """
+    pandas to_sql insertion method: send the rows with a single COPY FROM STDIN instead of INSERT statements.
+    """
+    dbapi_conn = conn.connection
+    with dbapi_conn.cursor() as cur:
+        # Rows are serialized as CSV in memory (missing values become empty unquoted cells, read as NULL by COPY)
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerows(data_iter)
+        buf.seek(0)
+
+        columns = ', '.join(f'"{key}"' for key in keys)
+        table_name = f'"{table.schema}"."{table.name}"' if table.schema else f'"{table.name}"'
+        cur.copy_expert(f"COPY {table_name} ({columns}) FROM STDIN WITH (FORMAT CSV)", buf)
+
+
+@lru_cache(maxsize=4)
+def get_engine(host, port, database, user, password):
+    """
+    Create the SQLAlchemy engine of a PostgreSQL database once and reuse it (and its connection pool) on the next calls.
+    Connections are checked before use since the engine can outlive a database restart in a long-lived Airflow worker.
+    """
+    engine_str = f"postgresql+psycopg2://{user}:{password}@{host}:{port}/{database}"
+    return create_engine(engine_str, pool_size=4, pool_pre_ping=True)
+
+
 def ingest_dataframe_to_postgres(df, table_name, pg_config):
     """
     Ingest the given DataFrame into PostgreSQL.
+    The table is (re)created by pandas, the rows are loaded with COPY by chunks of copy_chunksize rows.
+    If COPY fails, the load is retried with multi-row INSERT statements of insert_chunksize rows.
     """
-    engine_str = (
-        f"postgresql+psycopg2://{pg_config['postgres_user']}:{pg_config['postgres_password']}"
-        f"@{pg_config['host']}:{pg_config['port']}/{pg_config['database']}"
-    )
-    engine = create_engine(engine_str)
-    df.to_sql(table_name, engine, if_exists='replace', index=False)
+    engine = get_engine(pg_config['host'], pg_config['port'], pg_config['database'], pg_config['postgres_user'], pg_config['postgres_password'])
+    try:
+        df.to_sql(
+            table_name,
+            engine,
+            if_exists='replace',
+            index=False,
+            method=copy_rows_to_postgres,
+            chunksize=pg_config.get('copy_chunksize', 100000)
+        )
+    except Exception as e:
+        # to_sql runs in a single transaction, the failed attempt left nothing behind
+        print(f"COPY into PostgreSQL table '{table_name}' failed ({e}), falling back to multi-row INSERT.")
+        df.to_sql(
+            table_name,
+            engine,
+            if_exists='replace',
+            index=False,
+            method='multi',
+            chunksize=pg_config.get('insert_chunksize', 10000)
+        )
     print(f"Data ingested into PostgreSQL table '{table_name}'.")
 
 
@@ -209,6 +334,9 @@ def main():
     # Connect to Cassandra.
     cluster = Cluster([config["cassandra"]["host"]], port=config["cassandra"]["port"])
     session = cluster.connect()
+    # Plain tuples are cheaper to build than named Row objects, tables are read by pages of FETCH_SIZE rows
+    session.row_factory = tuple_factory
+    session.default_fetch_size = FETCH_SIZE
     keyspace = config["cassandra"]["keyspace"]
     session.set_keyspace(keyspace)
     
@@ -216,26 +344,27 @@ def main():
     table_names = list_tables(session, keyspace)
     if not table_names:
         print("No tables found in Cassandra for keyspace:", keyspace)
+        cluster.shutdown()
         return
     
     processed_dfs = []
     processed_table_names = [] 
     
-    for table in table_names:
-        print(f"Processing table: {table}")
-        df = load_table_to_dataframe(session, table)
-        if df.empty:
-            print(f"Table '{table}' is empty. Skipping.")
-            continue
-        
-        # Preprocess by adding table prefix 
-        df_processed = drop_unwanted_col_and_add_table_prefix(df, table)
-        if df_processed.empty:
-            print(f"After processing, table '{table}' has no rows. Skipping.")
-            continue
-        
-        processed_dfs.append(df_processed)
-        processed_table_names.append(table)
+    # Send the queries of all the tables at once, their first pages are fetched while the previous tables are processed.
+    # The queries are prepared (table names cannot be bound, so one statement per table) so Cassandra parses them only once.
+    futures = {table: session.execute_async(session.prepare(f"SELECT * FROM {table}")) for table in table_names}
+    
+    # Tables are loaded and prefixed in threads: the page fetches of one table overlap the pandas work of the others
+    with ThreadPoolExecutor(max_workers=min(8, len(table_names))) as executor:
+        results = list(executor.map(load_and_prefix_table, futures.keys(), futures.values()))
+    
+    for table, df_processed in zip(futures.keys(), results):
+        if df_processed is not None:
+            processed_dfs.append(df_processed)
+            processed_table_names.append(table)
+    
+    # Everything needed from Cassandra is loaded (close its connections, the script may run inside a long-lived Airflow worker)
+    cluster.shutdown()
     
     if not processed_dfs:
         print("No data loaded from any table after processing.")
@@ -250,14 +379,18 @@ def main():
     # Now perform unit conversion.
     merged_df = convert_units(merged_df)
     
+    # Classify the value columns once for the next steps (the total column is added by the aggregation).
+    value_columns, valeur_columns, valeur_brute_columns = classify_columns(merged_df.columns)
+    value_columns.append("total_valeur_particule_g_par_L")
+    
     # Aggregate pollutant values.
-    merged_df = aggregate_valeurs(merged_df)
+    merged_df = aggregate_valeurs(merged_df, valeur_columns, valeur_brute_columns)
 
     # Shift and calculate the difference between the current values and the values from 6 hours ago.
-    merged_df = shift_and_calculate_diff_6_hours_ago(merged_df)
+    merged_df = shift_and_calculate_diff_6_hours_ago(merged_df, value_columns)
 
     # Calculate the percentage change in particle values between the current values and the values from 6 hours ago.
-    merged_df = calculate_particle_variation(merged_df)
+    merged_df = calculate_particle_variation(merged_df, value_columns)
     
     print("Curated DataFrame:")
     print(merged_df.head(10))
@@ -1,37 +1,47 @@
-import os
+from pathlib import Path
 import requests
 
-def test_ingest():
+TEST_FILES_DIR = Path('../test_files')
+
+# One session for both tests, the second request reuses the connection of the first
+session = requests.Session()
+
+def load_test_files():
+    # Read every file from test_files once (the file handles are closed right away)
+    return [(path.name, path.read_bytes()) for path in sorted(TEST_FILES_DIR.iterdir())]
+
+def test_ingest(test_files=None):
 
     #test ingest function with all files from test_files
     base_url = 'http://localhost:5000'
     url = f'{base_url}/ingest'
 
-    files_list = []
-    for file in os.listdir('../test_files'):
-        files_list.append(('files', open(f'../test_files/{file}', 'rb')))
+    if test_files is None:
+        test_files = load_test_files()
+    files_list = [('files', (name, content)) for name, content in test_files]
 
-    response = requests.post(url, files=files_list)
+    response = session.post(url, files=files_list)
 
     print(response.status_code)
 
-def test_ingest_fast():
+def test_ingest_fast(test_files=None):
 
     #test ingest_fast function with all files from test_files
     base_url = 'http://localhost:5000'
     url = f'{base_url}/ingest/fast'
 
-    files_list = []
-    for file in os.listdir('../test_files'):
-        files_list.append(('files', open(f'../test_files/{file}', 'rb')))
+    if test_files is None:
+        test_files = load_test_files()
+    files_list = [('files', (name, content)) for name, content in test_files]
 
-    response = requests.post(url, files=files_list)
+    response = session.post(url, files=files_list)
 
     assert response.status_code == 200
 
 def main():
-    test_ingest()
-    test_ingest_fast()
+    test_files = load_test_files()
+    test_ingest(test_files)
+    test_ingest_fast(test_files)
 
 if __name__ == '__main__':
     main()
@@ -1,240 +1,601 @@
 import os
 import yaml
-import requests
+import logging
+import queue
 import time
 import io
+import json
+import random
+import sqlite3
+import asyncio
+import threading
+from collections import deque
+from dataclasses import dataclass
+import httpx
 import boto3
-from datetime import datetime, timedelta
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener
+from datetime import date, timedelta
+
+logger = logging.getLogger(__name__)
+
+# C implementation of the YAML parser (libyaml) when PyYAML was built with it
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+
+# Uploaded files larger than this are sent in concurrent multipart chunks,
+# streamed sources (API request files and responses) are read by blocks of 1 MiB instead of 256 KiB
+UPLOAD_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=16 * 1024 * 1024,
+    max_concurrency=10,
+    io_chunksize=1024 * 1024
+)
+
+# S3 clients are shared by concurrent uploads: enough pooled connections for all of them (the default is 10),
+# throttled or failed requests are retried with adaptive client-side rate limiting
+S3_CLIENT_CONFIG = Config(max_pool_connections=50, retries={"max_attempts": 10, "mode": "adaptive"})
+
+# GEODAIR API limit: 15 file generation requests per hour
+API_RATE_LIMIT = 15
+API_RATE_PERIOD = 3600
+# Transient server errors on which a download check is retried
+RETRY_STATUSES = {500, 502, 503, 504}
+# Generated file IDs are kept on disk for a day: a re-run after a failed download fetches the file again
+# without spending a generation request of the hourly budget
+FILE_ID_CACHE_EXPIRY = 24 * 3600
+
+
+class RateLimiter:
+    """
+    Sliding window rate limiter for asyncio tasks: at most `limit` acquisitions per `period` seconds.
+    """
+    def __init__(self, limit, period):
+        self.limit = limit
+        self.period = period
+        self.timestamps = deque()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            # Forget the requests that left the window, wait for the oldest one to leave it if the window is full
+            while self.timestamps and time.monotonic() - self.timestamps[0] >= self.period:
+                self.timestamps.popleft()
+            if len(self.timestamps) >= self.limit:
+                wait = self.period - (time.monotonic() - self.timestamps.popleft())
+                logger.info("API rate limit reached, waiting %.0f seconds...", wait)
+                await asyncio.sleep(wait)
+            self.timestamps.append(time.monotonic())
+
+
+@dataclass(frozen=True)
+class Settings:
+    """
+    Settings of the GEODAIR extraction, read from the configuration and the environment once per run.
+    """
+    api_key: str
+    base_url: str
+    last_n_days: int
+    file_id_cache: str
+    endpoint_url: str
+    bucket_name: str
+    aws_access_key_id: str
+    aws_secret_access_key: str
+
+    @classmethod
+    def from_config(cls, config):
+        # Get GEODAIR API key and other environment variables
+        api_key = os.getenv("GEODAIR_API_KEY")
+        if not api_key:
+            raise ValueError("GEODAIR_API_KEY is not set in the environment.")
+        data_source_config = config["data_source"]
+        s3_config = config["s3"]
+        return cls(
+            api_key=api_key,
+            base_url=data_source_config["base_url"],
+            last_n_days=data_source_config["last_n_days"],
+            file_id_cache=data_source_config["file_id_cache"],
+            endpoint_url=s3_config["endpoint_url"],
+            bucket_name=s3_config["bucket_name"],
+            aws_access_key_id=s3_config["aws_access_key_id"],
+            aws_secret_access_key=s3_config["aws_secret_access_key"]
+        )
+
+
+@contextmanager
+def queued_logging():
+    """
+    Send the records of this module through a queue to a background thread writing them with the root handlers
+    (the Airflow task log handlers during a task), the event loop and the upload threads never wait on the log output.
+    """
+    handlers = logging.getLogger().handlers
+    if not handlers:
+        yield
+        return
+    log_queue = queue.SimpleQueue()
+    queue_handler = QueueHandler(log_queue)
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    logger.addHandler(queue_handler)
+    logger.propagate = False
+    listener.start()
+    try:
+        yield
+    finally:
+        # Stopping the listener writes the records still in the queue
+        logger.removeHandler(queue_handler)
+        logger.propagate = True
+        listener.stop()
+
+
+@lru_cache(maxsize=8)
+def load_yaml_cached(path, mtime):
+    """
+    Parse a YAML file, cached on its path and modification time.
+    """
+    with open(path, "r") as file:
+        return yaml.load(file, Loader=SafeLoader)
+
+
+def load_yaml(path):
+    """
+    Load a YAML configuration file, parsed only once as long as it is not modified
+    (the API uploads and the Airflow worker load the same files on every call).
+    """
+    return load_yaml_cached(path, os.path.getmtime(path))
 
 
 def create_bucket_if_not_exists(s3_client, bucket_name):
     """
     Check if bucket exists, create it if not.
     """
-    buckets = s3_client.list_buckets().get("Buckets", [])
-    bucket_names = [bucket["Name"] for bucket in buckets]
-    
-    if bucket_name in bucket_names:
-        print(f"Bucket '{bucket_name}' already exists.")
-    else:
+    # A HEAD on the bucket instead of listing every bucket visible with these credentials
+    try:
+        s3_client.head_bucket(Bucket=bucket_name)
+        logger.info("Bucket '%s' already exists.", bucket_name)
+    except ClientError as e:
+        # 403 means the bucket exists but is not accessible, only a missing bucket is created
+        if e.response["Error"]["Code"] not in ("404", "NoSuchBucket"):
+            raise
         s3_client.create_bucket(Bucket=bucket_name)
-        print(f"Bucket '{bucket_name}' created successfully!")
+        logger.info("Bucket '%s' created successfully!", bucket_name)
 
 
 def generate_date_range(days):
     """
     Generate a list of dates for the last N days.
     """
-    today = datetime.today()
-    return [(today - timedelta(days=i + 1)).strftime("%Y-%m-%d") for i in range(days)]
+    today = date.today()
+    # date.isoformat gives the YYYY-MM-DD text directly (no format string to interpret)
+    return [(today - timedelta(days=i + 1)).isoformat() for i in range(days)]
+
+
+def open_file_id_cache(path):
+    """
+    Open the SQLite cache of generated file IDs (keyed on date and pollutant code), expired entries are removed.
+    """
+    connection = sqlite3.connect(path)
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS file_ids ("
+        "date TEXT, pollutant_code TEXT, file_id TEXT, created_at REAL, PRIMARY KEY (date, pollutant_code))"
+    )
+    connection.execute("DELETE FROM file_ids WHERE created_at < ?", (time.time() - FILE_ID_CACHE_EXPIRY,))
+    connection.commit()
+    return connection
 
 
-def request_file_generation(base_url, api_key, date, pollutant_code):
+async def request_file_generation(http_session, base_url, date, pollutant_code, rate_limiter):
     """
     Request generation of statistics file for a given date and pollutant.
     """
     export_url = f"{base_url}/MoyH/export?date={date}&polluant={pollutant_code}"
-    print(f"Requesting file generation via: {export_url}")
     
-    response = requests.get(export_url, headers={"apikey": api_key})
+    # Only the generation requests count in the API rate limit
+    await rate_limiter.acquire()
+    logger.info("Requesting file generation via: %s", export_url)
+    
+    response = await http_session.get(export_url)
     
     if response.status_code == 200:
         file_id = response.text.strip()
-        print(f"Received file ID: {file_id}")
+        logger.info("Received file ID: %s", file_id)
         return file_id
     else:
-        print(f"Error generating file: HTTP {response.status_code}")
+        logger.error("Error generating file: HTTP %s", response.status_code)
         return None
 
 
-def download_file(base_url, api_key, file_id, initial_delay=2, max_attempts=5, wait_between_attempts=2):
+class ResponseStream:
     """
-    Wait for an initial delay, then poll for file availability and download when ready.
+    Stream over the body of a streamed httpx response: read returns at most `size` bytes
+    (the rest of the body if negative), and an empty bytes object only at the end of the body.
+    """
+    def __init__(self, response):
+        self.chunks = response.aiter_bytes()
+        self.pending = b""
+        self.finished = False
+
+    async def read(self, size=-1):
+        if size is None or size < 0:
+            rest = [self.pending]
+            async for chunk in self.chunks:
+                rest.append(chunk)
+            self.pending = b""
+            self.finished = True
+            return b"".join(rest)
+        if not self.pending and not self.finished:
+            try:
+                self.pending = await self.chunks.__anext__()
+            except StopAsyncIteration:
+                self.finished = True
+        data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+    def at_eof(self):
+        return self.finished and not self.pending
+
+
+async def read_up_to(stream, size):
+    """
+    Read `size` bytes from a response stream, or less only if the end of the body is reached.
+    """
+    chunks = []
+    remaining = size
+    while remaining > 0:
+        chunk = await stream.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b"".join(chunks)
+
+
+class ResponseBodyReader(io.RawIOBase):
+    """
+    Blocking file-like reader over the rest of an httpx response body, for a boto3 upload running in a worker thread.
+    Each read is run on the event loop, so the upload sends its parts while the rest of the body is still downloading.
+    """
+    def __init__(self, first_chunk, stream, loop):
+        super().__init__()
+        self.pending = first_chunk
+        self.stream = stream
+        self.loop = loop
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = self.pending + asyncio.run_coroutine_threadsafe(self.stream.read(), self.loop).result()
+            self.pending = b""
+            return data
+        data, self.pending = self.pending[:size], self.pending[size:]
+        if len(data) < size:
+            # Parts must have their full size (except the last one), short reads from the network are completed here
+            data += asyncio.run_coroutine_threadsafe(read_up_to(self.stream, size - len(data)), self.loop).result()
+        return data
+
+
+async def download_file_to_s3(http_session, base_url, file_id, s3_client, bucket_name, s3_key, initial_delay=2, max_attempts=5, base_wait=1.0, max_wait=30):
+    """
+    Wait for an initial delay, then poll for file availability and upload it to S3 when ready.
+    The wait between checks doubles at each attempt (from base_wait up to max_wait, plus a random jitter).
+    The waits are asyncio sleeps, the other files are requested and downloaded meanwhile.
+    A file larger than the multipart threshold is streamed from the API response to a multipart upload,
+    it is never fully held in memory.
     """
     download_url = f"{base_url}/download?id={file_id}"
+    loop = asyncio.get_running_loop()
     
     # Wait before starting to poll the API (function is called multiple times and file generation from API side takes time)
-    print(f"Waiting for {initial_delay} seconds before starting checks...")
-    time.sleep(initial_delay)
+    logger.info("Waiting for %s seconds before starting checks...", initial_delay)
+    await asyncio.sleep(initial_delay)
     
     attempt = 0
     while attempt < max_attempts:
-        response = requests.get(download_url, headers={"apikey": api_key})
-        
-        # Try to parse the response as JSON
         try:
-            data = response.json()
-        except ValueError:
-            data = None
-
-        # Check if the JSON contains a 'status' field
-        if data and "status" in data:
-            if data["status"] == 412:
-                print("File not ready yet, waiting 2 seconds before next check...")
-                time.sleep(wait_between_attempts)
-                attempt += 1
-                continue
-            elif data["status"] == 429:
-                raise Exception("API rate limit exceeded. 15/h is the limit. Try again after 1 hour.")
-
-        # If no error status is detected, assume the file is ready for download.
-        print("File is ready for download.")
-        print(response)
-        print(response.content[:100])
-        return response.content
-
-    print(f"Failed to download file after {max_attempts} attempts.")
-    return None
+            async with http_session.stream("GET", download_url) as response:
+                if response.status_code in RETRY_STATUSES:
+                    retry_reason = f"HTTP {response.status_code}"
+                else:
+                    # Status responses are small JSON bodies: only a body read to its end is checked for a status
+                    stream = ResponseStream(response)
+                    first_chunk = await read_up_to(stream, UPLOAD_TRANSFER_CONFIG.multipart_threshold)
+                    complete = stream.at_eof()
+                    
+                    data = None
+                    if complete:
+                        # Try to parse the response as JSON
+                        try:
+                            data = json.loads(first_chunk)
+                        except ValueError:
+                            data = None
+
+                    # Check if the JSON contains a 'status' field
+                    if isinstance(data, dict) and "status" in data and data["status"] == 429:
+                        raise Exception("API rate limit exceeded. 15/h is the limit. Try again after 1 hour.")
+                    if isinstance(data, dict) and "status" in data and data["status"] == 412:
+                        retry_reason = "File not ready yet"
+                    else:
+                        # If no error status is detected, assume the file is ready for download.
+                        logger.info("File is ready for download.")
+                        if logger.isEnabledFor(logging.DEBUG):
+                            logger.debug("%s\n%r", response, first_chunk[:100])
+                        
+                        # Upload to S3 (boto3 is blocking, the upload runs in the default thread pool)
+                        content = first_chunk if complete else ResponseBodyReader(first_chunk, stream, loop)
+                        return await loop.run_in_executor(None, upload_to_s3, s3_client, bucket_name, content, s3_key)
+        except httpx.TransportError as e:
+            # Connection lost/refused or timed out, polling again is safe (it does not count in the API rate limit)
+            retry_reason = f"Connection error ({e!r})"
+        
+        # Exponential backoff, the jitter keeps the concurrent downloads from polling at the same time
+        delay = min(max_wait, base_wait * (2 ** attempt)) + random.uniform(0, 0.5)
+        logger.info("%s (attempt %d/%d), waiting %.1f seconds before next check...", retry_reason, attempt + 1, max_attempts, delay)
+        await asyncio.sleep(delay)
+        attempt += 1
+
+    logger.error("Failed to download file after %d attempts.", max_attempts)
+    return False
 
 
 def upload_to_s3(s3_client, bucket_name, content, s3_key):
     """
-    Upload content to S3 bucket.
+    Upload content (bytes or a readable file object) to S3 bucket.
+    Content in memory is sent with a single PUT, a file object is streamed in concurrent multipart chunks.
     """
     try:
-        s3_client.upload_fileobj(io.BytesIO(content), bucket_name, s3_key)
-        print(f"File saved to S3: s3://{bucket_name}/{s3_key}")
+        if isinstance(content, bytes):
+            s3_client.put_object(Bucket=bucket_name, Key=s3_key, Body=content)
+        else:
+            s3_client.upload_fileobj(content, bucket_name, s3_key, Config=UPLOAD_TRANSFER_CONFIG)
+        logger.info("File saved to S3: s3://%s/%s", bucket_name, s3_key)
         return True
     except Exception as e:
-        print(f"Error during upload: {e}")
+        logger.error("Error during upload: %s", e)
         return False
 
 
-def process_pollutant_data(base_url, api_key, s3_client, bucket_name, date, pollutant):
+def raw_s3_key(pollutant_code, date):
+    """
+    S3 key of the file of a pollutant for a date.
+    """
+    return f"{pollutant_code}/polluant-{pollutant_code}_{date}.csv"
+
+
+def list_existing_keys(s3_client, bucket_name, pollutants):
+    """
+    List the keys already in the bucket under the prefix of each pollutant (one LIST per pollutant instead of a HEAD per file).
+    """
+    existing_keys = set()
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for pollutant_code in sorted({pollutant["code"] for pollutant in pollutants}):
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=f"{pollutant_code}/"):
+            existing_keys.update(obj["Key"] for obj in page.get("Contents", []))
+    return existing_keys
+
+
+async def submit_pollutant_data(http_session, base_url, date, pollutant, rate_limiter, file_id_cache):
     """
-    Process data for a single pollutant on a specific date.
+    Request the generation of the file of a single pollutant on a specific date,
+    unless a previous run already generated it (its file ID is then read from the cache).
     """
     pollutant_code = pollutant["code"]
     pollutant_short_name = pollutant["short_name"]
-    print(f"\nProcessing pollutant: {pollutant_short_name} (Code: {pollutant_code})")
+    logger.info("Processing pollutant: %s (Code: %s) for date: %s", pollutant_short_name, pollutant_code, date)
+    
+    cached = file_id_cache.execute(
+        "SELECT file_id FROM file_ids WHERE date = ? AND pollutant_code = ?", (date, pollutant_code)
+    ).fetchone()
+    if cached:
+        logger.info("Reusing cached file ID: %s", cached[0])
+        return cached[0]
     
     # Request file generation
-    file_id = request_file_generation(base_url, api_key, date, pollutant_code)
-    if not file_id:
-        return False
+    file_id = await request_file_generation(http_session, base_url, date, pollutant_code, rate_limiter)
+    if file_id:
+        file_id_cache.execute(
+            "INSERT OR REPLACE INTO file_ids VALUES (?, ?, ?, ?)", (date, pollutant_code, file_id, time.time())
+        )
+        file_id_cache.commit()
+    return file_id
+
+
+async def fetch_pollutant_data(http_session, base_url, s3_client, bucket_name, date, pollutant, file_id):
+    """
+    Download the generated file of a single pollutant on a specific date and upload it to S3.
+    """
+    s3_key = raw_s3_key(pollutant["code"], date)
+    return await download_file_to_s3(http_session, base_url, file_id, s3_client, bucket_name, s3_key)
+
+
+async def process_all_pollutant_data(settings, s3_client, dates, pollutants, file_id_cache):
+    """
+    Process the data of every pollutant for every date concurrently, in two phases:
+    the generation of all the files is requested first (the server prepares them in parallel),
+    then all the files are downloaded and uploaded to S3.
+    Files already in the bucket are skipped and the file IDs of a previous run are reused
+    (the API allows only 15 requests per hour).
+    """
+    # Bound to locals once, they are read for every job below
+    base_url = settings.base_url
+    bucket_name = settings.bucket_name
     
-    # Download file
-    file_content = download_file(base_url, api_key, file_id)
-    if not file_content:
-        return False
+    existing_keys = list_existing_keys(s3_client, bucket_name, pollutants)
+    jobs = {}
+    for date in dates:
+        for pollutant in pollutants:
+            s3_key = raw_s3_key(pollutant["code"], date)
+            if s3_key in existing_keys:
+                logger.info("File for pollutant %s on %s already in S3, skipping.", pollutant["short_name"], date)
+            else:
+                # Keyed on the S3 key: a pollutant code listed twice (or a repeated date) is requested and downloaded once
+                jobs.setdefault(s3_key, (date, pollutant))
+    jobs = list(jobs.values())
+    
+    # Created inside the running event loop (asyncio primitives bind to the loop on Python 3.8)
+    rate_limiter = RateLimiter(API_RATE_LIMIT, API_RATE_PERIOD)
+    # One client for all the API calls: with HTTP/2 the concurrent requests are multiplexed over a single
+    # connection to the API (one TLS handshake), HTTP/1.1 servers get up to 20 kept-alive connections
+    limits = httpx.Limits(max_connections=20, max_keepalive_connections=20, keepalive_expiry=60)
+    timeout = httpx.Timeout(None, connect=10, read=60)
+    async with httpx.AsyncClient(http2=True, headers={"apikey": settings.api_key}, limits=limits, timeout=timeout) as http_session:
+        # Phase 1: request the generation of every file
+        file_ids = await asyncio.gather(
+            *[submit_pollutant_data(http_session, base_url, date, pollutant, rate_limiter, file_id_cache) for date, pollutant in jobs],
+            return_exceptions=True
+        )
+        
+        # Phase 2: download the files that were generated (their initial delays overlap)
+        results = [file_id if isinstance(file_id, Exception) else False for file_id in file_ids]
+        fetched = [i for i, file_id in enumerate(file_ids) if file_id and not isinstance(file_id, Exception)]
+        fetch_results = await asyncio.gather(
+            *[fetch_pollutant_data(http_session, base_url, s3_client, bucket_name, *jobs[i], file_ids[i]) for i in fetched],
+            return_exceptions=True
+        )
+        for i, result in zip(fetched, fetch_results):
+            results[i] = result
+            if result is True:
+                # The file is in S3 now, the next runs skip it without needing its ID
+                date, pollutant = jobs[i]
+                file_id_cache.execute("DELETE FROM file_ids WHERE date = ? AND pollutant_code = ?", (date, pollutant["code"]))
+        file_id_cache.commit()
     
-    # Upload to S3
-    filename = f"polluant-{pollutant_code}_{date}.csv"
-    s3_key = f"{pollutant_code}/{filename}"
-    return upload_to_s3(s3_client, bucket_name, file_content, s3_key)
+    errors = [result for result in results if isinstance(result, Exception)]
+    for error in errors:
+        logger.error("Error while processing pollutant data: %s", error)
+    # Every job was given its chance, then the task fails so that Airflow retries it (e.g. after the API rate limit)
+    if errors:
+        raise RuntimeError(f"{len(errors)} pollutant file(s) could not be processed") from errors[0]
+    return results
 
 
 def main():
     # Load configurations
-    with open("/opt/airflow/config/config.yaml", "r") as file:
-        config = yaml.safe_load(file)
-    with open("/opt/airflow/config/pollutants.yaml", "r") as file:
-        pollutants = yaml.safe_load(file)
+    config = load_yaml("/opt/airflow/config/config.yaml")
+    pollutants = load_yaml("/opt/airflow/config/pollutants.yaml")
 
     # Load configurations without Airflow
-    """with open("config/config.yaml", "r") as file:
-        config = yaml.safe_load(file)
-    with open("config/pollutants.yaml", "r") as file:
-        pollutants = yaml.safe_load(file)"""
-    
-    # Get GEODAIR API key and other environment variables
-    api_key = os.getenv("GEODAIR_API_KEY")
-    if not api_key:
-        raise ValueError("GEODAIR_API_KEY is not set in the environment.")
-    
-    aws_access_key_id = config["s3"]["aws_access_key_id"]
-    aws_secret_access_key = config["s3"]["aws_secret_access_key"]
+    """config = load_yaml("config/config.yaml")
+    pollutants = load_yaml("config/pollutants.yaml")"""
     
-    # Get configuration parameters
-    base_url = config["data_source"]["base_url"]
-    last_n_days = config["data_source"]["last_n_days"]
-    bucket_name = config["s3"]["bucket_name"]
+    # Configuration and environment are resolved once, the settings are passed to the processing functions
+    settings = Settings.from_config(config)
     
     # Connect to S3
     s3 = boto3.client(
         "s3",
-        endpoint_url=config["s3"]["endpoint_url"],
-        aws_access_key_id=aws_access_key_id,
-        aws_secret_access_key=aws_secret_access_key
+        endpoint_url=settings.endpoint_url,
+        aws_access_key_id=settings.aws_access_key_id,
+        aws_secret_access_key=settings.aws_secret_access_key,
+        config=S3_CLIENT_CONFIG
     )
-    bucket_name = config["s3"]["bucket_name"]
 
     # Create bucket if it does not exist
-    create_bucket_if_not_exists(s3, bucket_name)
+    create_bucket_if_not_exists(s3, settings.bucket_name)
     
     # Generate date range
-    dates = generate_date_range(last_n_days)
+    dates = generate_date_range(settings.last_n_days)
     
-    # Process data for each date and pollutant
-    for date in dates:
-        print(f"\nProcessing data for date: {date}")
-        
-        for pollutant in pollutants:
-            process_pollutant_data(
-                base_url, 
-                api_key, 
-                s3, 
-                bucket_name, 
-                date, 
-                pollutant
-            )
+    # Process data for each date and pollutant (all the API requests are sent concurrently)
+    file_id_cache = open_file_id_cache(settings.file_id_cache)
+    try:
+        with queued_logging():
+            asyncio.run(process_all_pollutant_data(settings, s3, dates, pollutants, file_id_cache))
+    finally:
+        file_id_cache.close()
 
 
-def upload_to_S3_with_csv(files):
+# Upload threads shared by the API calls: they live as long as the API process, and so do their S3 clients
+UPLOAD_EXECUTOR = ThreadPoolExecutor(max_workers=16)
+thread_local = threading.local()
+
+
+def get_thread_s3_client(s3_config):
     """
-    Uploads a list of CSV files to S3 following the same naming convention as process_pollutant_data.
+    Return the S3 client of the current thread, created on its first call.
+    Each upload thread signs its requests and keeps its connections alive with its own client (and boto3 session,
+    sessions are not thread-safe) instead of contending on a single shared client.
+    """
+    s3_clients = getattr(thread_local, "s3_clients", None)
+    if s3_clients is None:
+        s3_clients = thread_local.s3_clients = {}
+    client_key = (s3_config["endpoint_url"], s3_config["aws_access_key_id"])
+    if client_key not in s3_clients:
+        s3_clients[client_key] = boto3.session.Session().client(
+            "s3",
+            endpoint_url=s3_config["endpoint_url"],
+            aws_access_key_id=s3_config["aws_access_key_id"],
+            aws_secret_access_key=s3_config["aws_secret_access_key"],
+            config=S3_CLIENT_CONFIG
+        )
+    return s3_clients[client_key]
+
+
+def upload_csv_file_to_s3(s3_config, bucket_name, file):
     """
-    with open("../config/config.yaml", "r") as file:
-        config = yaml.safe_load(file)
+    Upload a single CSV file to S3 following the same naming convention as process_pollutant_data.
+    """
+    if not file.filename.endswith(".csv"):
+        logger.warning("Invalid file format: %s", file.filename)
+        return False
 
-    if config is None:
-        raise ValueError("Config file not found")
-    if files is None:
-        raise ValueError("No files provided")
+    # Extract pollutant code and date from filename
+    base_filename = os.path.splitext(file.filename)[0]  # Remove .csv extension
 
-    aws_access_key_id = config["s3"]["aws_access_key_id"]
-    aws_secret_access_key = config["s3"]["aws_secret_access_key"]
+    if not base_filename.startswith("polluant-"):
+        logger.warning("Skipping file %s: Invalid naming format.", file.filename)
+        return False
 
-    s3_client = boto3.client(
-        "s3",
-        endpoint_url=config["s3"]["endpoint_url"],
-        aws_access_key_id=aws_access_key_id,
-        aws_secret_access_key=aws_secret_access_key
-    )
+    parts = base_filename.split("_")
+    if len(parts) != 2:
+        logger.warning("Skipping file %s: Unexpected filename structure.", file.filename)
+        return False
 
-    bucket_name = config["s3"]["bucket_name"]
-    create_bucket_if_not_exists(s3_client, bucket_name)
+    pollutant_code = parts[0].replace("polluant-", "")  # Extract "04" from "polluant-04"
+    date_part = parts[1]  # Extract "2025-03-08"
 
-    for file in files:
-        if file.filename.endswith(".csv"):
-            try:
-                content = file.stream.read()
+    s3_key = f"{pollutant_code}/polluant-{pollutant_code}_{date_part}.csv"
 
-                # Extract pollutant code and date from filename
-                base_filename = os.path.splitext(file.filename)[0]  # Remove .csv extension
+    # The upload is streamed from the request to S3, without reading the whole file in memory first
+    s3_client = get_thread_s3_client(s3_config)
+    s3_client.upload_fileobj(file.stream, bucket_name, s3_key, Config=UPLOAD_TRANSFER_CONFIG)
+    logger.info("Uploaded %s to S3 as %s", file.filename, s3_key)
+    return True
 
-                if not base_filename.startswith("polluant-"):
-                    print(f"Skipping file {file.filename}: Invalid naming format.")
-                    continue
 
-                parts = base_filename.split("_")
-                if len(parts) != 2:
-                    print(f"Skipping file {file.filename}: Unexpected filename structure.")
-                    continue
+def upload_to_S3_with_csv(files):
+    """
+    Uploads a list of CSV files to S3 following the same naming convention as process_pollutant_data.
+    """
+    config = load_yaml("../config/config.yaml")
 
-                pollutant_code = parts[0].replace("polluant-", "")  # Extract "04" from "polluant-04"
-                date_part = parts[1]  # Extract "2025-03-08"
+    if config is None:
+        raise ValueError("Config file not found")
+    if files is None:
+        raise ValueError("No files provided")
 
-                s3_key = f"{pollutant_code}/polluant-{pollutant_code}_{date_part}.csv"
+    s3_config = config["s3"]
+    bucket_name = s3_config["bucket_name"]
+    create_bucket_if_not_exists(get_thread_s3_client(s3_config), bucket_name)
 
-                upload_to_s3(s3_client, bucket_name, content, s3_key)
-                print(f"Uploaded {file.filename} to S3 as {s3_key}")
-            except Exception as e:
-                print(f"Error uploading file {file.filename} to S3: {e}")
-        else:
-            print(f"Invalid file format: {file.filename}")
+    # The files are uploaded in parallel by the upload threads, each with its own S3 client
+    futures = {UPLOAD_EXECUTOR.submit(upload_csv_file_to_s3, s3_config, bucket_name, file): file for file in files}
+    for future in as_completed(futures):
+        try:
+            future.result()
+        except Exception as e:
+            logger.error("Error uploading file %s to S3: %s", futures[future].filename, e)
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
     main()
     # to test if data has been saved to s3 enter the following command on the terminal
     # aws --endpoint-url=http://localhost:4566 s3 ls raw --recursive
\ No newline at end of file